@@ -11,10 +11,14 @@ import json
 from sqlalchemy.exc import OperationalError
 import time
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+import sqlite3
+import pathlib
 import subprocess
 import os
 from Tools.DatabaseConnect.docker_create import run_container
 import threading
+import atexit
 import sys
 import logging
 import time
@@ -45,10 +49,23 @@ for handler in root_logger.handlers:
 current_file_path = os.path.abspath(__file__)
 current_dir = os.path.dirname(current_file_path)
 
+# 语句执行超时时error_message的前缀，调用方据此区分超时和普通的执行错误
+TIMEOUT_ERROR_PREFIX = "[TIMEOUT] "
+# 服务端数据库在语句超时后返回的错误信息
+SERVER_TIMEOUT_ERRORS = (
+    "canceling statement due to statement timeout",  # postgres
+    "maximum statement execution time exceeded",  # mysql/tidb max_execution_time
+    "max_statement_time exceeded",  # mariadb
+)
+
+
+def is_timeout_error(error_message):
+    return error_message is not None and error_message.startswith(TIMEOUT_ERROR_PREFIX)
 
 
 class DatabaseConnectionPool:
-    def __init__(self, dbType, host, port, username, password, dbname, pool_size=20, max_overflow=20):
+    def __init__(self, dbType, host, port, username, password, dbname, pool_size=20, max_overflow=20,
+                 db_file=None, readonly=False):
         self.dbType = dbType.upper()
         self.host = host
         self.port = port
@@ -57,6 +74,9 @@ class DatabaseConnectionPool:
         self.dbname = dbname
         self.pool_size = pool_size
         self.max_overflow = max_overflow
+        # sqlite/duckdb：直接打开已有的db文件（如spider的.sqlite），readonly时以只读方式打开
+        self.db_file = db_file
+        self.readonly = readonly
         self.engine = None
         self.create_engine()
 
@@ -90,6 +110,18 @@ class DatabaseConnectionPool:
                     f'monetdb+pymonetdb://{self.username}:{self.password}@{self.host}:{self.port}/{self.dbname}',
                     pool_size=self.pool_size,
                 )
+            elif self.dbType == 'SQLITE' and self.db_file is not None:
+                # 以URI方式打开已有文件，mode=ro保证predict sql无法修改原始数据库，因此不需要复制db文件
+                uri = pathlib.Path(os.path.abspath(self.db_file)).as_uri()
+                if self.readonly:
+                    uri += "?mode=ro"
+                self.engine = create_engine(
+                    "sqlite://",
+                    creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+                    poolclass=QueuePool,
+                    pool_size=self.pool_size,
+                    max_overflow=self.max_overflow
+                )
             elif self.dbType == 'SQLITE':
                 # For SQLite, it uses a file path, not a typical "host/database" format
                 db_path = f'sqlite:///{os.path.join(current_dir, self.dbname)}.sqlite'
@@ -109,6 +141,13 @@ class DatabaseConnectionPool:
             elif self.dbType == 'OCEANBASE':
                 # For OceanBase, if SQLAlchemy is not supported, you would use a different mechanism
                 self.engine = None
+            elif self.dbType == 'DUCKDB' and self.db_file is not None:
+                self.engine = create_engine(
+                    f'duckdb:///{os.path.abspath(self.db_file)}',
+                    connect_args={"read_only": self.readonly},
+                    pool_size=self.pool_size,
+                    max_overflow=self.max_overflow
+                )
             elif self.dbType == 'DUCKDB':
                 # For duckdb, it uses a file path, not a typical "host/database" format
                 db_path = f'duckdb:///{os.path.join(current_dir, self.dbname)}.duckdb'
@@ -132,10 +171,56 @@ class DatabaseConnectionPool:
             print(f"Failed to close database connection: {e}")
             raise
 
-    def execSQL(self, query):
+    def set_statement_timeout(self, connection, timeout, timed_out):
+        """
+        为即将执行的语句设置超时，超时后真正中断执行而不是等待其结束：
+        sqlite通过progress handler中断，duckdb通过interrupt()中断，
+        postgres/mysql/mariadb/tidb使用服务端的语句超时设置。
+        :param timed_out: 长度为1的list，本地中断时置为True
+        :return: 执行结束后恢复连接设置的函数，不支持超时的数据库返回None
+        """
+        if timeout is None:
+            return None
+        if self.dbType == 'SQLITE':
+            raw_connection = connection.connection.driver_connection
+            deadline = time.monotonic() + timeout
+
+            def progress_handler():
+                if time.monotonic() > deadline:
+                    timed_out[0] = True
+                    return 1  # 非0返回值使sqlite中断当前语句
+                return 0
+            raw_connection.set_progress_handler(progress_handler, 1000)
+            return lambda: raw_connection.set_progress_handler(None, 1000)
+        if self.dbType == 'DUCKDB':
+            raw_connection = connection.connection.driver_connection
+
+            def interrupt():
+                timed_out[0] = True
+                raw_connection.interrupt()
+            timer = threading.Timer(timeout, interrupt)
+            timer.daemon = True
+            timer.start()
+            return timer.cancel
+        if self.dbType == 'POSTGRES':
+            connection.execute(text(f"SET statement_timeout = {int(timeout * 1000)}"))
+            return lambda: connection.execute(text("SET statement_timeout = 0"))
+        if self.dbType in ['MYSQL', 'TIDB']:
+            connection.execute(text(f"SET SESSION max_execution_time = {int(timeout * 1000)}"))
+            return lambda: connection.execute(text("SET SESSION max_execution_time = 0"))
+        if self.dbType == 'MARIADB':
+            connection.execute(text(f"SET SESSION max_statement_time = {timeout}"))
+            return lambda: connection.execute(text("SET SESSION max_statement_time = 0"))
+        return None
+
+    def execSQL(self, query, timeout=None):
+        """
+        :param timeout: 语句执行超时时间（秒），None表示不限制。超时的语句返回以TIMEOUT_ERROR_PREFIX开头的错误信息
+        """
         start_time = time.time()  # 开始计时
         affected_rows = 0  # 初始化受影响的行数
         result = None  # 初始化结果为 None
+        timed_out = [False]
         try:
             if self.dbType == 'OCEANBASE':
                 conn = pymysql.connect(host=self.host, port=int(self.port), user=self.username, password=self.password,
@@ -152,22 +237,30 @@ class DatabaseConnectionPool:
                 with self.engine.connect() as connection:
                     # 设置自动提交
                     connection.execution_options(isolation_level="AUTOCOMMIT")
-                    res = connection.execute(text(query))
-                    affected_rows = res.rowcount
-                    if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'CREATE')):
-                        connection.commit()
-                    else:
-                        # 对于其他类型的查询，如 SELECT，获取结果
-                        result = res.fetchall()
+                    reset_timeout = self.set_statement_timeout(connection, timeout, timed_out)
+                    try:
+                        res = connection.execute(text(query))
+                        affected_rows = res.rowcount
+                        if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'CREATE')):
+                            connection.commit()
+                        else:
+                            # 对于其他类型的查询，如 SELECT，获取结果
+                            result = res.fetchall()
+                    finally:
+                        self.reset_statement_timeout(reset_timeout)
             else:
                 with self.engine.connect() as connection:
-                    res = connection.execute(text(query))
-                    affected_rows = res.rowcount
-                    if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'CREATE')):
-                        connection.commit()
-                    else:
-                        # 对于其他类型的查询，如 SELECT，获取结果
-                        result = res.fetchall()
+                    reset_timeout = self.set_statement_timeout(connection, timeout, timed_out)
+                    try:
+                        res = connection.execute(text(query))
+                        affected_rows = res.rowcount
+                        if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'CREATE')):
+                            connection.commit()
+                        else:
+                            # 对于其他类型的查询，如 SELECT，获取结果
+                            result = res.fetchall()
+                    finally:
+                        self.reset_statement_timeout(reset_timeout)
             end_time = time.time()  # 结束计时
             execution_time = end_time - start_time  # 计算执行时间
             print("Affected rows:", affected_rows)
@@ -175,14 +268,115 @@ class DatabaseConnectionPool:
         except Exception as e:
             error_message = f"Error executing '{query}':" + str(e)
             print(f"Error executing '{query}':", e)
+            if timed_out[0] or any(err in str(e) for err in SERVER_TIMEOUT_ERRORS):
+                return None, time.time() - start_time, TIMEOUT_ERROR_PREFIX + str(e)
             # return None, 0 , error_message
             return None, 0, str(e)
 
+    @staticmethod
+    def reset_statement_timeout(reset_timeout):
+        if reset_timeout is None:
+            return
+        try:
+            reset_timeout()
+        except Exception as e:
+            logging.warning(f"Failed to reset statement timeout: {e}")
+
+    def streamSQL(self, query, timeout=None, batch_size=1000):
+        """
+        流式执行只读查询，结果行通过返回的SQLStream按批读取，而不是一次fetchall到内存中
+        :param timeout: 语句执行超时时间（秒），包括读取结果行的时间
+        :return: SQLStream，执行出错时其error_message不为None
+        """
+        return SQLStream(self, query, timeout, batch_size)
+
+
+class SQLStream:
+    """
+    流式执行的只读查询：执行语句后保持连接，batches()每次fetchmany(batch_size)行。
+    执行或读取出错（包括超时）时停止读取并设置error_message，格式与execSQL的返回一致。
+    读取完毕或调用close()后释放连接，调用方可以在读完之前close()提前结束。
+    exec_time只统计该查询自身执行和读取的时间，多个SQLStream交替读取时互不影响；
+    sqlite/duckdb的超时在本地计时，每次读取前按剩余的时间重新设置。
+    """
+    def __init__(self, pool, query, timeout=None, batch_size=1000):
+        self.query = query
+        self.batch_size = batch_size
+        self.error_message = None
+        self.exec_time = 0
+        self.rows_read = 0
+        self.done = False
+        self._pool = pool
+        self._timeout = timeout
+        self._timed_out = [False]
+        self._reset_timeout = None
+        self._connection = None
+        self._result = None
+        start_time = time.time()
+        try:
+            self._connection = pool.engine.connect()
+            self._reset_timeout = pool.set_statement_timeout(self._connection, timeout, self._timed_out)
+            self._result = self._connection.execute(text(query))
+        except Exception as e:
+            self.exec_time += time.time() - start_time
+            self._fail(e)
+            return
+        self.exec_time += time.time() - start_time
+
+    def _rearm_timeout(self):
+        if self._timeout is None or self._pool.dbType not in ['SQLITE', 'DUCKDB']:
+            return
+        self._pool.reset_statement_timeout(self._reset_timeout)
+        self._reset_timeout = self._pool.set_statement_timeout(self._connection, max(self._timeout - self.exec_time, 0),
+                                                               self._timed_out)
+
+    def _fail(self, e):
+        print(f"Error executing '{self.query}':", e)
+        if self._timed_out[0] or any(err in str(e) for err in SERVER_TIMEOUT_ERRORS):
+            self.error_message = TIMEOUT_ERROR_PREFIX + str(e)
+        else:
+            self.error_message = str(e)
+        self.close()
+        if not is_timeout_error(self.error_message):
+            self.exec_time = 0
+
+    def batches(self):
+        """生成器，每次返回一批结果行（list），读取完毕、出错或close()之后结束"""
+        while not self.done:
+            start_time = time.time()
+            try:
+                self._rearm_timeout()
+                batch = self._result.fetchmany(self.batch_size)
+            except Exception as e:
+                self.exec_time += time.time() - start_time
+                self._fail(e)
+                return
+            self.exec_time += time.time() - start_time
+            if not batch:
+                self.close()
+                return
+            self.rows_read += len(batch)
+            yield batch
+
+    def close(self):
+        if self.done:
+            return
+        self.done = True
+        try:
+            if self._result is not None:
+                self._result.close()
+        finally:
+            if self._connection is not None:
+                self._pool.reset_statement_timeout(self._reset_timeout)
+                self._connection.close()
+
 
 # 每次执行后要清除数据库内的所有表格
 def database_clear(tool, exp, dbType):
     args = get_database_connector_args(dbType.lower())
     args["dbname"] = f"{tool}_{exp}_{dbType}".lower() if "tlp" not in exp else f"{tool}_tlp_{dbType}".lower()
+    # 清除前先释放注册表中该库的连接，避免删除文件/重建数据库时仍有连接占用（连接池按执行时的库名登记）
+    close_connection_pool(args["dbType"], get_exec_dbname(tool, exp, dbType))
     # 特殊处理：删除对应的db文件即可
     if dbType.lower() in ["sqlite"]:
         db_filepath = os.path.join(current_dir,f'{args["dbname"]}.db')
@@ -236,60 +430,137 @@ def exec_sql_statement(tool, exp, dbType, sql_statement):
     return result, exec_time, error_message
 """
 
-def exec_sql_statement(tool, exp, dbType, sql_statement):
+# 进程内共享的连接池注册表：(dbType, dbname, readonly) -> DatabaseConnectionPool
+# 连接池按需创建并在多次执行之间复用，进程退出或显式调用close_connection_pools时统一释放
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_exec_dbname(tool, exp, dbType):
+    if tool.lower() in ["sqlancer", "sqlright"]:
+        tool = "sqlancer"
+    return f"{tool}_{exp}_{dbType}".lower() if "tlp" not in exp else f"{tool}_tlp_{dbType}".lower()
+
+
+def get_connection_pool(dbType, dbname, args=None, db_file=None, readonly=False):
+    """
+    从注册表中获取连接池，不存在时创建。只在创建时检查一次连接，之后的执行直接复用已建立的连接。
+    :param args: database_connector_args.json中对应数据库的连接参数，db_file不为None时可省略
+    :param db_file: sqlite/duckdb已有的数据库文件路径
+    :return: DatabaseConnectionPool, 是否为新创建的连接池
+    """
+    key = (dbType.upper(), dbname, readonly)
+    with _connection_pools_lock:
+        pool = _connection_pools.get(key)
+        if pool is not None:
+            return pool, False
+        if db_file is not None:
+            pool = DatabaseConnectionPool(dbType, "", 0, "", "", dbname, db_file=db_file, readonly=readonly)
+        else:
+            pool = DatabaseConnectionPool(args["dbType"], args["host"], args["port"],
+                                          args["username"], args["password"], dbname)
+        _connection_pools[key] = pool
+        return pool, True
+
+
+def close_connection_pool(dbType, dbname):
+    """关闭并移除注册表中某个数据库的所有连接池"""
+    with _connection_pools_lock:
+        keys = [key for key in _connection_pools if key[0] == dbType.upper() and key[1] == dbname]
+        pools = [_connection_pools.pop(key) for key in keys]
+    for pool in pools:
+        try:
+            pool.close()
+        except Exception as close_error:
+            logging.warning(f"Failed to close database connection pool: {close_error}")
+
+
+def close_connection_pools():
+    """关闭注册表中的所有连接池"""
+    with _connection_pools_lock:
+        pools = list(_connection_pools.values())
+        _connection_pools.clear()
+    for pool in pools:
+        try:
+            pool.close()
+        except Exception as close_error:
+            logging.warning(f"Failed to close database connection pool: {close_error}")
+
+
+atexit.register(close_connection_pools)
+
+
+def exec_sql_statement(tool, exp, dbType, sql_statement, timeout=None):
     """
     执行SQL语句并检测Crash Bug。
+    连接池从注册表中复用，只有在首次创建或执行出错时才检查连接状态。
     :param tool: 测试工具名称
     :param exp: 实验名称
     :param dbType: 数据库类型，例如 mysql, postgres
     :param sql_statement: 待执行的SQL语句
+    :param timeout: 语句执行超时时间（秒），None表示不限制
     :return: result, exec_time, error_message, crash_detected
     """
     try:
-        # 创建连接池实例
-        if tool.lower() in ["sqlancer", "sqlright"]:
-            tool = "sqlancer"
         args = get_database_connector_args(dbType.lower())
-        args["dbname"] = (
-            f"{tool}_{exp}_{dbType}".lower()
-            if "tlp" not in exp else f"{tool}_tlp_{dbType}".lower()
-        )
-        # 初始化连接池
-        pool = DatabaseConnectionPool(
-            args["dbType"], args["host"], args["port"],
-            args["username"], args["password"], args["dbname"]
-        )
-        # 检查连接，如果失败则尝试启动数据库容器
-        # if dbType not in ["clickhouse"] and not pool.check_connection():
-        if not pool.check_connection():
+        args["dbname"] = get_exec_dbname(tool, exp, dbType)
+        pool, created = get_connection_pool(args["dbType"], args["dbname"], args)
+        # 新建的连接池检查连接，如果失败则尝试启动数据库容器
+        if created and not pool.check_connection():
             logging.warning(f"Database connection failed. Attempting to restart container for {dbType}...")
             run_container(tool, exp, dbType)
             if not pool.check_connection():
+                close_connection_pool(args["dbType"], args["dbname"])
                 raise Exception("Failed to establish database connection after restarting the container.")
         # 执行SQL语句
         try:
-            result, exec_time, error_message = pool.execSQL(sql_statement)
+            result, exec_time, error_message = pool.execSQL(sql_statement, timeout)
             crash_detected = False
         except Exception as e:
             result = None
+            exec_time = None
             error_message = str(e)
             crash_detected = True
             logging.critical(
                 f"Database crash detected during SQL execution! SQL: {sql_statement}\nError: {error_message}")
-        # 检查数据库状态是否存活:如果连接失败，认为有崩溃错误导致其退出
-        if not pool.check_connection():
+        # 执行出错时检查数据库状态是否存活:如果连接失败，认为有崩溃错误导致其退出
+        if error_message is not None and not pool.check_connection():
             crash_detected = True
             logging.critical(f"Database became unreachable after executing the SQL statement. Possible crash detected:{sql_statement}\nError: {error_message}")
+            # 丢弃失效的连接池，下次执行时重新创建并检查连接
+            close_connection_pool(args["dbType"], args["dbname"])
         return result, exec_time, error_message, crash_detected
     except Exception as general_error:
         logging.critical(f"Unexpected error: {general_error}")
         return None, None, str(general_error), True
-    finally:
-        # 确保连接池关闭
-        try:
-            pool.close()
-        except Exception as close_error:
-            logging.warning(f"Failed to close database connection pool: {close_error}")
+
+
+def exec_sql_on_file(db_file, dbType, sql_statement, readonly=True, timeout=None):
+    """
+    直接在已有的数据库文件上执行SQL语句（sqlite/duckdb），不需要复制db文件或启动容器。
+    :param db_file: 数据库文件路径，例如spider的xxx.sqlite
+    :param dbType: 数据库类型，sqlite或duckdb
+    :param sql_statement: 待执行的SQL语句
+    :param readonly: 是否以只读方式打开数据库文件
+    :param timeout: 语句执行超时时间（秒），None表示不限制
+    :return: result, exec_time, error_message, crash_detected
+    """
+    try:
+        pool, _ = get_connection_pool(dbType, os.path.abspath(db_file), db_file=db_file, readonly=readonly)
+        result, exec_time, error_message = pool.execSQL(sql_statement, timeout)
+        return result, exec_time, error_message, False
+    except Exception as general_error:
+        logging.critical(f"Unexpected error: {general_error}")
+        return None, None, str(general_error), True
+
+def stream_sql_on_file(db_file, dbType, sql_statement, readonly=True, timeout=None, batch_size=1000):
+    """
+    在已有的数据库文件上流式执行只读SQL语句，参数同exec_sql_on_file
+    :return: SQLStream，通过batches()分批读取结果行，读取结束后exec_time为执行和读取的总时间
+    """
+    pool, _ = get_connection_pool(dbType, os.path.abspath(db_file), db_file=db_file, readonly=readonly)
+    return pool.streamSQL(sql_statement, timeout, batch_size)
+
 
 def run_with_timeout(func, timeout, *args, **kwargs):
     result = [None, None, None]  # 使用列表来存储返回值，因为列表是可变的
@@ -297,13 +568,13 @@ def run_with_timeout(func, timeout, *args, **kwargs):
     def thread_func():
         result[0], result[1], result[2] = func(*args, **kwargs)
 
-    thread = threading.Thread(target=thread_func)
+    # daemon线程：超时后不再等待其结束，也不会阻止进程退出
+    thread = threading.Thread(target=thread_func, daemon=True)
     thread.start()
     thread.join(timeout)
 
     if thread.is_alive():
-        # 若线程未完成则中断并抛出超时异常
-        thread.join()  # 等待线程结束
+        # 线程无法被强制终止，直接抛出超时异常；需要真正中断执行时应使用execSQL的timeout参数
         raise TimeoutError("Function call timed out.")
 
     return result[0], result[1], result[2]  # 返回函数的执行结果
@@ -320,11 +591,17 @@ def database_define_pinolo(tool, exp, dbType):
     pool.close()
 
 
+_database_connection_args = None
+
+
 def get_database_connector_args(dbType):
-    with open(os.path.join(current_dir, "database_connector_args.json"), "r", encoding="utf-8") as r:
-        database_connection_args = json.load(r)
-    if dbType.lower() in database_connection_args:
-        return database_connection_args[dbType.lower()]
+    # 连接参数文件只读取一次，返回副本，调用方可以直接修改（如设置dbname）
+    global _database_connection_args
+    if _database_connection_args is None:
+        with open(os.path.join(current_dir, "database_connector_args.json"), "r", encoding="utf-8") as r:
+            _database_connection_args = json.load(r)
+    if dbType.lower() in _database_connection_args:
+        return dict(_database_connection_args[dbType.lower()])
 
 def database_connect_test():
     # 1.PINOLO
@@ -0,0 +1,251 @@
+from typing import List, Tuple, Optional, Sequence, Dict, Any
+from operator import itemgetter
+import numpy as np
+from Tools.OracleChecker.oracle_check import Result, RowNormalizer
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+# 两个结果集的总行数少于该值时直接使用Result.cmp：转换为数组的固定开销大于逐行比较
+MIN_COLUMNAR_ROWS = 64
+# 与float一起比较的int转为float64，绝对值超过该值的int转换后会丢失精度
+_MAX_EXACT_FLOAT_INT = 2 ** 53
+_NONE_TYPE = type(None)
+
+
+class _Fallback(Exception):
+    """结果集不能按列比较（混合类型等），回退到Result.cmp"""
+
+
+def _encode_strings(values: Sequence[str]) -> np.ndarray:
+    """values为两个结果集同一列的所有字符串，返回共享的整数编码，相同的字符串编码相同"""
+    if pa is not None:
+        try:
+            indices = pa.array(values, type=pa.string()).dictionary_encode().indices
+            return indices.to_numpy(zero_copy_only=False).astype(np.int64)
+        except (pa.ArrowException, UnicodeError):
+            pass  # 如包含不能编码为utf-8的字符（surrogate）
+    codes = {}
+    setdefault = codes.setdefault
+    return np.array([setdefault(value, len(codes)) for value in values], dtype=np.int64)
+
+
+def _group_ids(keys: np.ndarray) -> np.ndarray:
+    """keys为二维int64数组，返回每行的分组编号，各列都相同的行编号相同"""
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    starts = np.empty(len(keys), dtype=bool)
+    starts[0] = True
+    np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1, out=starts[1:])
+    groups = np.empty(len(keys), dtype=np.int64)
+    groups[order] = np.cumsum(starts) - 1
+    return groups
+
+
+class ColumnarComparator:
+    """
+    向量化的结果集比较：将两个结果集按列转换为numpy数组，通过排序/分组比较，返回值与Result.cmp相同。
+    适用于聚合查询等行数多、以数值列为主的结果集，不需要对每个值做str转换和逐行生成key。
+    每列编码为int64的key列：
+        int列直接使用；float列使用规范化后的float64的二进制表示（NaN统一为同一个值，typed模式下-0.0与0.0相同），
+        typed模式下int与float一起比较的列都转为float64；str列按两个结果集共享的字典编码为整数
+        （安装了pyarrow时使用dictionary_encode）；数值列中的None额外用一列标记
+    与normalizer的比较方式一致，以下情况回退到Result.cmp：
+        某一列包含混合类型（如str模式下同时有int和float，含None的str列，Decimal/bytes等），
+        两个结果集同一列的类型不同（typed模式下int与float除外），
+        int超出int64（或与float一起比较时超出2**53），typed模式下numeric_strings为True且有str列，
+        按ORDER BY比较时行数不同（前缀的判断见Result.cmp_ordered）
+    typed模式下float_digits的四舍五入使用np.round，在二进制表示恰好为.5的边界上可能与python的round不同
+
+    atol/rtol: float列的容差，column_tolerances为{列下标: (atol, rtol)}，覆盖对应列的容差。
+        有容差时两个结果集分别排序后逐行比较（|a - b| <= atol + rtol * |b|），只判断是否相等：相等返回0，否则返回2。
+        值很接近的行排序后的配对可能与精确比较不同；回退到Result.cmp时不使用容差
+    """
+    def __init__(self, normalizer: Optional[RowNormalizer] = None, atol: float = 0.0, rtol: float = 0.0,
+                 column_tolerances: Optional[Dict[int, Tuple[float, float]]] = None,
+                 min_rows: int = MIN_COLUMNAR_ROWS):
+        self.normalizer = normalizer if normalizer is not None else RowNormalizer()
+        self.atol = atol
+        self.rtol = rtol
+        self.column_tolerances = column_tolerances or {}
+        self.min_rows = min_rows
+        self.typed = self.normalizer.mode == "typed"
+
+    def cmp(self, result1: Result, result2: Result,
+            order_columns: Optional[Sequence[int]] = None) -> Tuple[int, Optional[Exception]]:
+        """与result1.cmp(result2, order_columns)相同"""
+        if (result1.err or result2.err or result1.is_empty() or result2.is_empty()
+                or len(result1.column_names) != len(result2.column_names)
+                or result1.normalizer is None or result2.normalizer is None):
+            return result1.cmp(result2, order_columns)
+        # 结果行可能是只能遍历一次的迭代器，先转为list，回退时Result.cmp仍可以使用
+        for result in (result1, result2):
+            if not isinstance(result.rows, (list, tuple)):
+                result.rows = list(result.rows)
+        if len(result1.rows) + len(result2.rows) < self.min_rows:
+            return result1.cmp(result2, order_columns)
+        try:
+            return self.cmp_rows(result1.rows, result2.rows, order_columns), None
+        except _Fallback:
+            return result1.cmp(result2, order_columns)
+
+    def cmp_rows(self, rows1: Sequence[Sequence[Any]], rows2: Sequence[Sequence[Any]],
+                 order_columns: Optional[Sequence[int]] = None) -> int:
+        """比较两个非空、列数相同的结果集，不能按列比较时抛出_Fallback"""
+        n1 = len(rows1)
+        width = len(rows1[0])
+        keys1, keys2, floats, key_index = self.encode([list(map(itemgetter(j), rows1)) for j in range(width)],
+                                                      [list(map(itemgetter(j), rows2)) for j in range(width)])
+        if any(tolerance != (0.0, 0.0) for _, _, _, tolerance in floats):
+            return self._cmp_tolerance(keys1, keys2, floats, key_index, order_columns)
+
+        stacked = np.vstack([np.column_stack(keys1), np.column_stack(keys2)])
+        groups = _group_ids(stacked)
+        groups1, groups2 = groups[:n1], groups[n1:]
+        if order_columns is not None:
+            return self._cmp_ordered(stacked, groups1, groups2, key_index, order_columns)
+
+        counts1 = np.bincount(groups1, minlength=len(stacked))
+        counts2 = np.bincount(groups2, minlength=len(stacked))
+        # 与Result.cmp相同：all_in_another为result1的每行在result2中都有对应，exhausted为result2的行都已匹配
+        all_in_another = bool(np.all(counts1 <= counts2))
+        exhausted = bool(np.all(counts2 <= counts1))
+        if all_in_another:
+            return 0 if exhausted else -1
+        return 1 if exhausted else 2
+
+    def _cmp_ordered(self, stacked: np.ndarray, groups1: np.ndarray, groups2: np.ndarray,
+                     key_index: List[List[int]], order_columns: Sequence[int]) -> int:
+        """
+        按ORDER BY的顺序比较：排序列的值逐行相同，且排序列的值相同的每一段内，行作为多重集相同。
+        行数相同而不相等时必然返回2；行数不同时是否为前缀交给Result.cmp_ordered判断
+        """
+        if len(groups1) != len(groups2):
+            raise _Fallback()
+        n1 = len(groups1)
+        order_keys = stacked[:, [i for column in order_columns for i in key_index[column]]]
+        order_groups = _group_ids(order_keys)
+        order1, order2 = order_groups[:n1], order_groups[n1:]
+        if not np.array_equal(order1, order2):
+            return 2
+        runs = np.concatenate([[0], np.cumsum(order1[1:] != order1[:-1])])
+        sorted1 = groups1[np.lexsort((groups1, runs))]
+        sorted2 = groups2[np.lexsort((groups2, runs))]
+        return 0 if np.array_equal(sorted1, sorted2) else 2
+
+    def _cmp_tolerance(self, keys1: List[np.ndarray], keys2: List[np.ndarray],
+                       floats: List[Tuple[int, np.ndarray, np.ndarray, Tuple[float, float]]],
+                       key_index: List[List[int]], order_columns: Optional[Sequence[int]]) -> int:
+        """有容差的比较：两个结果集分别按（ORDER BY的段、）精确比较的列、float列排序后逐行比较"""
+        if len(keys1[0]) != len(keys2[0]):
+            return 2
+        float_positions = {i for i, _, _, _ in floats}
+        exact = [i for i in range(len(keys1)) if i not in float_positions]
+
+        def sort_order(keys, values):
+            sort_keys = list(values[::-1]) + [keys[i] for i in exact[::-1]]
+            if order_columns is not None:
+                order_keys = np.column_stack([keys[i] for column in order_columns for i in key_index[column]])
+                changed = np.any(order_keys[1:] != order_keys[:-1], axis=1)
+                sort_keys.append(np.concatenate([[0], np.cumsum(changed)]))
+            return np.lexsort(sort_keys)
+
+        sorted1 = sort_order(keys1, [values1 for _, values1, _, _ in floats])
+        sorted2 = sort_order(keys2, [values2 for _, _, values2, _ in floats])
+        for i in exact:
+            if not np.array_equal(keys1[i][sorted1], keys2[i][sorted2]):
+                return 2
+        for _, values1, values2, (atol, rtol) in floats:
+            if not np.all(np.isclose(values1[sorted1], values2[sorted2], rtol=rtol, atol=atol, equal_nan=True)):
+                return 2
+        return 0
+
+    def encode(self, columns1: List[List], columns2: List[List]):
+        """
+        将两个结果集的各列编码为int64的key列
+        :return: (keys1, keys2, floats, key_index)
+            keys1/keys2: 两个结果集的key列；key_index[j]: 第j列对应的key列的下标
+            floats: 每个float列的(key列下标, values1, values2, (atol, rtol))，values为规范化后的float64，
+                    其二进制表示即为该key列
+        """
+        keys1, keys2, floats, key_index = [], [], [], []
+        for j, (column1, column2) in enumerate(zip(columns1, columns2)):
+            types1, nullable1 = self._column_types(column1)
+            types2, nullable2 = self._column_types(column2)
+            start = len(keys1)
+            if str in types1 or str in types2:
+                if (types1 != {str} or types2 != {str} or nullable1 or nullable2
+                        or (self.typed and self.normalizer.numeric_strings)):
+                    raise _Fallback()
+                codes = _encode_strings(column1 + column2)
+                keys1.append(codes[:len(column1)])
+                keys2.append(codes[len(column1):])
+            else:
+                if self.typed:
+                    as_float = float in types1 or float in types2
+                elif len(types1) > 1 or len(types2) > 1 or (types1 and types2 and types1 != types2):
+                    # str模式下int与float的str不会相等，但含None时仍可能有行相同，交给Result.cmp
+                    raise _Fallback()
+                else:
+                    as_float = float in types1 or float in types2
+                values1, nulls1 = self._numeric_column(column1, nullable1, as_float)
+                values2, nulls2 = self._numeric_column(column2, nullable2, as_float)
+                if nullable1 or nullable2:
+                    keys1.append(nulls1.astype(np.int64))
+                    keys2.append(nulls2.astype(np.int64))
+                if as_float:
+                    tolerance = self.column_tolerances.get(j, (self.atol, self.rtol))
+                    floats.append((len(keys1), values1, values2, tolerance))
+                    keys1.append(values1.view(np.int64))
+                    keys2.append(values2.view(np.int64))
+                else:
+                    keys1.append(values1)
+                    keys2.append(values2)
+            key_index.append(list(range(start, len(keys1))))
+        return keys1, keys2, floats, key_index
+
+    def _column_types(self, column: List) -> Tuple[set, bool]:
+        """:return: (列中除None以外的类型, 是否有None)，有int/float/str以外的类型时抛出_Fallback"""
+        types = set(map(type, column))
+        nullable = _NONE_TYPE in types
+        types.discard(_NONE_TYPE)
+        if bool in types:
+            if not self.typed:
+                raise _Fallback()  # str模式下为'True'/'False'
+            types.discard(bool)
+            types.add(int)
+        if not types <= {int, float, str}:
+            raise _Fallback()
+        return types, nullable
+
+    def _numeric_column(self, column: List, nullable: bool, as_float: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """:return: (values, nulls)，None的位置values为0，nulls为None的掩码"""
+        if nullable:
+            nulls = np.fromiter((value is None for value in column), dtype=bool, count=len(column))
+            column = [0 if value is None else value for value in column]
+        else:
+            nulls = np.zeros(len(column), dtype=bool)
+        types = set(map(type, column))
+        if as_float and float in types and len(types) > 1:
+            # 同时有int和float的列直接转为float64，先检查int的精度
+            if any(type(value) is int and not -_MAX_EXACT_FLOAT_INT <= value <= _MAX_EXACT_FLOAT_INT
+                   for value in column):
+                raise _Fallback()
+        try:
+            values = np.array(column, dtype=np.float64 if as_float and float in types else np.int64)
+        except OverflowError:
+            raise _Fallback()
+        if values.dtype == np.int64 and as_float:
+            if np.any((values > _MAX_EXACT_FLOAT_INT) | (values < -_MAX_EXACT_FLOAT_INT)):
+                raise _Fallback()
+            values = values.astype(np.float64)
+        if as_float:
+            if self.typed:
+                if self.normalizer.float_digits is not None:
+                    values = np.round(values, self.normalizer.float_digits)
+                values = values + 0.0  # -0.0与0.0相同
+            values[np.isnan(values)] = np.nan
+        return values, nulls
@@ -1,25 +1,134 @@
 from typing import Tuple,Sequence
 from sqlalchemy.engine.row import Row
-from typing import List, Tuple, Optional, Union,Sequence
+from typing import List, Tuple, Optional, Union,Sequence, Any, Hashable, Iterable
 from time import time
+import math
+import hashlib
+import decimal
+import itertools
+import operator
+import collections
 import pymysql
 from sqlalchemy import create_engine, text
 
 
+_NAN = float("nan")  # 所有NaN规范化为同一个对象，使NaN之间可以匹配
+
+
+class RowNormalizer:
+    """
+    将sql执行结果中的一行（原生的tuple/Row）直接转换为可hash的key用于结果集比较，不生成中间的字符串列表。
+    mode='str'：每行按(str(v1), str(v2), ...)的tuple比较。这是有意的修正，与原来execSQL_result_convertor + flat_rows
+        将一行用逗号拼接成一个字符串后比较并不完全相同：原来('a,b', 'c')与('a', 'b,c')会被判为相等，现在不相等
+    mode='typed'：按类型规范化后比较
+        int/float/Decimal/bool按数值比较（1、1.0、Decimal('1.0')相等），float_digits不为None时先四舍五入到该小数位数；
+        NaN之间相等；bytes按utf-8解码后按字符串比较；None保持为None（与字符串'None'不相等）；
+        numeric_strings为True时，可以解析为数值的字符串也按数值比较
+    """
+    def __init__(self, mode: str = "str", float_digits: Optional[int] = None, numeric_strings: bool = False):
+        if mode not in ("str", "typed"):
+            raise ValueError(f"[RowNormalizer]unknown mode {mode}")
+        self.mode = mode
+        self.float_digits = float_digits
+        self.numeric_strings = numeric_strings
+        # 规范化方式的名称，记录在结果的指纹中：只有规范化方式相同的指纹之间可以比较
+        self.name = mode if mode == "str" or float_digits is None else f"{mode}/{float_digits}"
+        if mode == "typed" and numeric_strings:
+            self.name += "/numeric_strings"
+        # 这些类型的值在typed模式下不需要转换
+        self._plain_types = {int, type(None)} if numeric_strings else {int, str, type(None)}
+
+    def normalize(self, value: Any) -> Hashable:
+        if self.mode == "str":
+            return str(value)
+        if value is None or type(value) is int:
+            return value
+        if isinstance(value, (float, decimal.Decimal)):
+            return self._normalize_float(float(value))
+        if isinstance(value, int):  # bool和int的子类
+            return int(value)
+        if isinstance(value, str):
+            return self._normalize_string(value)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self._normalize_string(bytes(value).decode("utf-8", errors="surrogateescape"))
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            return str(value)
+
+    def _normalize_float(self, value: float) -> float:
+        if value != value:
+            return _NAN
+        if self.float_digits is not None and math.isfinite(value):
+            value = round(value, self.float_digits)
+        # 整数值的float转为int，使相等的数值有相同的repr（ResultDigest按repr计算行hash）
+        if value.is_integer():
+            return int(value)
+        return value
+
+    def _normalize_string(self, value: str) -> Hashable:
+        if self.numeric_strings:
+            try:
+                return self._normalize_float(float(value))
+            except ValueError:
+                pass
+        return value
+
+    def row_key(self, row: Sequence[Any]) -> Tuple:
+        if self.mode == "str":
+            return tuple(map(str, row))
+        plain_types = self._plain_types
+        for value in row:
+            if type(value) not in plain_types:
+                normalize = self.normalize
+                return tuple([value if type(value) in plain_types else normalize(value) for value in row])
+        # 不需要转换的行直接作为key，不再分配新的tuple
+        return row if type(row) is tuple else tuple(row)
+
+
 class Result:
-    def __init__(self, column_names: List[str], column_types: List[str], rows: List[List[str]],
-                 err: Optional[Exception] = None):
+    def __init__(self, column_names: List[str], column_types: List[str], rows: Iterable[Sequence[Any]],
+                 err: Optional[Exception] = None, normalizer: Optional[RowNormalizer] = None):
+        """
+        rows: normalizer为None时为字符串列表的列表（execSQL_result_convertor的格式）；
+              否则为原生的执行结果行，可以是list，也可以是游标等只能遍历一次的可迭代对象
+        """
         self.column_names = column_names
         self.column_types = column_types
         self.rows = rows
         self.err = err
+        self.normalizer = normalizer
+        self.fingerprint_rows = False  # 为True时在比较生成key的同一遍中计算结果指纹，见fingerprint
+        self.digest = None
+
+    @classmethod
+    def from_rows(cls, rows: Optional[Iterable[Sequence[Any]]], normalizer: RowNormalizer,
+                  fingerprint: bool = False) -> 'Result':
+        """
+        由原生的sql执行结果构造Result，rows不做复制也不转换为字符串，比较时由normalizer逐行生成key。
+        与execSQL_result_convertor一致：没有结果行时为空结果，列名为c0, c1, ...
+        fingerprint: 为True时比较的同时计算结果指纹（ResultDigest），之后由fingerprint()取得
+        """
+        iterator = iter(rows) if rows is not None else iter(())
+        first = next(iterator, None)
+        if first is None:
+            result = cls([], [], [], normalizer=normalizer)
+        else:
+            column_names = ["c" + str(i) for i in range(len(first))]
+            column_types = [type(value) for value in first]
+            if not isinstance(rows, (list, tuple)):
+                rows = itertools.chain([first], iterator)
+            result = cls(column_names, column_types, rows, normalizer=normalizer)
+        result.fingerprint_rows = fingerprint
+        return result
 
     def to_string(self) -> str:
         result_str = "ColumnName(ColumnType)s: "
         result_str += " ".join([f"{name}({type_})" for name, type_ in zip(self.column_names, self.column_types)])
         result_str += "\n"
         for i, row in enumerate(self.rows):
-            result_str += f"row {i}: {' '.join(row)}\n"
+            result_str += f"row {i}: {' '.join(map(str, row))}\n"
         if self.err:
             result_str += f"Error: {self.err}\n"
         return result_str
@@ -27,6 +136,26 @@ class Result:
     def flat_rows(self) -> List[str]:
         return [",".join(row) for row in self.rows]
 
+    def row_keys(self) -> Iterable[Hashable]:
+        """逐行生成用于比较的key，rows只遍历一次"""
+        if self.normalizer is None:
+            return (",".join(row) for row in self.rows)
+        keys = map(self.normalizer.row_key, self.rows)
+        if self.fingerprint_rows:
+            # 每次遍历重新计算，只有完整遍历了所有行的摘要才是完整的
+            self.digest = ResultDigest(self.normalizer)
+            return self.digest.hash_keys(keys)
+        return keys
+
+    def fingerprint(self) -> 'ResultDigest':
+        """
+        结果集的指纹。比较时已经完整遍历过结果行则直接返回同一遍中计算的摘要；
+        否则（空结果、列数不同、按顺序比较提前结束、ColumnarComparator等）单独遍历一遍rows计算，此时rows需要可以重复遍历
+        """
+        if self.digest is None or not self.digest.complete:
+            self.digest = ResultDigest.from_rows(self.rows, self.normalizer)
+        return self.digest
+
     def is_empty(self) -> bool:
         return len(self.column_names) == 0
 
@@ -36,7 +165,11 @@ class Result:
         else:
             return -1, Exception(f"[Result.GetErrorCode]not mysql.connector.Error {type(self.err).__name__}")
 
-    def cmp(self, another: 'Result') -> Tuple[int, Optional[Exception]]:
+    def cmp(self, another: 'Result', order_columns: Optional[Sequence[int]] = None) -> Tuple[int, Optional[Exception]]:
+        """
+        order_columns为None时将两个结果集作为多重集比较；
+        否则（gold sql有ORDER BY）为排序列在结果中的下标，按顺序比较，见cmp_ordered
+        """
         if self.err:
             return -2, Exception("[Result.CMP]self error")
         if another.err:
@@ -55,13 +188,14 @@ class Result:
         if len(self.column_names) != len(another.column_names):
             return 2, None
 
-        res1 = self.flat_rows()
-        res2 = another.flat_rows()
+        if order_columns is not None:
+            return self.cmp_ordered(another, order_columns)
+
+        res1 = self.row_keys()
+        res2 = another.row_keys()
 
-        mp = {}
-        # 遍历res2，如果元素r已在字典中，就将其频次加1；否则将其初始频次设置为1。
-        for r in res2:
-            mp[r] = mp.get(r, 0) + 1
+        # 统计res2中每个元素的频次
+        mp = collections.Counter(res2)
 
         all_in_another = True
         # 检查res1中的元素是否存在于res2中
@@ -92,8 +226,202 @@ class Result:
                 return 1, None
             return 2, None
 
-def Check(originResult: Result, mutatedResult: Result, isUpper: bool, isSame: bool) -> Tuple[bool, str]:
-    cmp, err = originResult.cmp(mutatedResult)
+    def order_runs(self, order_columns: Sequence[int]) -> Iterable[Tuple[Tuple, collections.Counter]]:
+        """按顺序逐个生成(排序列的值, 段内各行key的计数)，一段为排序列的值相同的相邻行"""
+        if self.normalizer is None:
+            pairs = ((tuple([row[i] for i in order_columns]), ",".join(row)) for row in self.rows)
+        else:
+            pairs = ((tuple([key[i] for i in order_columns]), key) for key in self.row_keys())
+        for order_key, group in itertools.groupby(pairs, key=operator.itemgetter(0)):
+            yield order_key, collections.Counter(key for _, key in group)
+
+    def cmp_ordered(self, another: 'Result', order_columns: Sequence[int]) -> Tuple[int, Optional[Exception]]:
+        """
+        按ORDER BY的顺序比较：两个结果集按排序列划分为段后，各段的排序列的值依次相同、段内的行作为多重集相同。
+        排序列的值相同的行之间的顺序不确定，不影响比较；单遍完成，不需要排序，遇到第一处不同即返回。
+        完全相同返回0；self是another的前缀返回-1；another是self的前缀返回1（如LIMIT更小的结果）；否则返回2
+        """
+        runs1 = self.order_runs(order_columns)
+        runs2 = another.order_runs(order_columns)
+        for run1, run2 in itertools.zip_longest(runs1, runs2):
+            if run1 is None:
+                return -1, None
+            if run2 is None:
+                return 1, None
+            if run1[0] != run2[0]:
+                return 2, None
+            if run1[1] != run2[1]:
+                # LIMIT可能在排序列的值相同的行中间截断：较短一边的最后一段是另一边对应段的子集时仍为前缀
+                if run1[1] <= run2[1] and next(runs1, None) is None:
+                    return -1, None
+                if run2[1] <= run1[1] and next(runs2, None) is None:
+                    return 1, None
+                return 2, None
+        return 0, None
+
+
+def row_hash(key: Hashable) -> int:
+    """规范化后的行key的64位hash，由repr计算，不受PYTHONHASHSEED影响，不同进程/运行之间一致"""
+    data = repr(key).encode("utf-8", errors="surrogatepass")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+class ResultDigest:
+    """
+    顺序无关的结果集摘要：行数、列数以及各行64位hash的和（mod 2^64）与异或，随读取的结果行增量更新。
+    两个结果集作为多重集相等时摘要一定相同；摘要不同时结果集一定不同。
+    sample_size: 额外保留的前若干行原始结果，用于输出
+    order_columns: 不为None时，另外按排序列把结果划分为段（见Result.cmp_ordered），
+                   每段读完后将(排序列的值, 行数, hash和, hash异或)追加到runs中，用于按顺序比较
+    """
+    def __init__(self, normalizer: RowNormalizer, sample_size: int = 0, order_columns: Optional[Sequence[int]] = None):
+        self.normalizer = normalizer
+        self.sample_size = sample_size
+        self.order_columns = order_columns
+        self.runs = collections.deque()
+        self._run = None  # 当前未结束的段
+        self.rows = 0
+        self.columns = None
+        self.hash_sum = 0
+        self.hash_xor = 0
+        self.sample = []
+        self.complete = False  # 是否已读完全部结果行
+
+    def add_rows(self, rows: Iterable[Sequence[Any]]):
+        row_key = self.normalizer.row_key
+        order_columns = self.order_columns
+        hash_sum = self.hash_sum
+        hash_xor = self.hash_xor
+        count = 0
+        # 与row_hash相同，内联以减少每行的函数调用
+        blake2b = hashlib.blake2b
+        from_bytes = int.from_bytes
+        for row in rows:
+            if self.columns is None:
+                self.columns = len(row)
+                # 列数比排序列的下标少时结果集不可能相等，不再划分段
+                if order_columns is not None and max(order_columns, default=-1) >= self.columns:
+                    self.order_columns = order_columns = None
+            if len(self.sample) < self.sample_size:
+                self.sample.append(tuple(row))
+            key = row_key(row)
+            h = from_bytes(blake2b(repr(key).encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+            hash_sum += h
+            hash_xor ^= h
+            count += 1
+            if order_columns is not None:
+                order_key = tuple([key[i] for i in order_columns])
+                if self._run is None or self._run[0] != order_key:
+                    self.end_run()
+                    self._run = [order_key, 0, 0, 0]
+                self._run[1] += 1
+                self._run[2] = (self._run[2] + h) & 0xFFFFFFFFFFFFFFFF
+                self._run[3] ^= h
+        self.hash_sum = hash_sum & 0xFFFFFFFFFFFFFFFF
+        self.hash_xor = hash_xor
+        self.rows += count
+
+    def hash_keys(self, keys: Iterable[Hashable]) -> Iterable[Hashable]:
+        """
+        逐个返回已经规范化的行key，同时更新行数、列数和hash（与add_rows相同），全部返回后complete为True。
+        用于在Result比较生成key的同一遍中计算摘要，不记录sample和段
+        """
+        hash_sum = 0
+        hash_xor = 0
+        count = 0
+        blake2b = hashlib.blake2b
+        from_bytes = int.from_bytes
+        for key in keys:
+            h = from_bytes(blake2b(repr(key).encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+            hash_sum += h
+            hash_xor ^= h
+            count += 1
+            yield key
+        if count and self.columns is None:
+            self.columns = len(key)
+        self.hash_sum = (self.hash_sum + hash_sum) & 0xFFFFFFFFFFFFFFFF
+        self.hash_xor ^= hash_xor
+        self.rows += count
+        self.complete = True
+
+    def end_run(self):
+        """结束当前的段（读完全部结果行时调用）"""
+        if self._run is not None:
+            self.runs.append(tuple(self._run))
+            self._run = None
+
+    @classmethod
+    def from_rows(cls, rows: Optional[Iterable[Sequence[Any]]], normalizer: RowNormalizer) -> Optional['ResultDigest']:
+        """完整结果集的摘要，rows为None（执行出错或没有结果集）时返回None"""
+        if rows is None:
+            return None
+        digest = cls(normalizer)
+        digest.add_rows(rows)
+        digest.complete = True
+        return digest
+
+    def same_as(self, another: 'ResultDigest') -> bool:
+        return (self.rows, self.columns, self.hash_sum, self.hash_xor) == \
+               (another.rows, another.columns, another.hash_sum, another.hash_xor)
+
+    def to_dict(self) -> dict:
+        """
+        作为结果集的指纹保存：complete为True时，相同规范化方式（normalizer）下指纹相同即结果集相同（不考虑顺序）
+        """
+        return {"rows": self.rows, "columns": self.columns, "complete": self.complete,
+                "sum": format(self.hash_sum, "016x"), "xor": format(self.hash_xor, "016x"),
+                "normalizer": self.normalizer.name}
+
+
+def stream_bag_equal(batches1: Iterable[Sequence[Sequence[Any]]], batches2: Iterable[Sequence[Sequence[Any]]],
+                     normalizer: RowNormalizer, sample_size: int = 0,
+                     order_columns: Optional[Sequence[int]] = None) -> Tuple[bool, ResultDigest, ResultDigest]:
+    """
+    流式比较两个结果集是否相等（与Check(.., isSame=True)的判定一致），两边的结果交替按批读取，
+    内存占用与结果行数无关。一边读完后另一边的行数已经超过它，或两边列数不同时提前结束读取。
+    order_columns不为None时按顺序比较（见Result.cmp_ordered）：两边已读完的段依次对齐比较，遇到第一处不同即结束。
+    :param batches1/batches2: 结果行的批次的可迭代对象，如SQLStream.batches()
+    :return: (是否相等, 摘要1, 摘要2)，提前结束时未读完一边的摘要complete为False
+    """
+    digest1 = ResultDigest(normalizer, sample_size, order_columns)
+    digest2 = ResultDigest(normalizer, sample_size, order_columns)
+    iter1 = iter(batches1)
+    iter2 = iter(batches2)
+    order_mismatch = False
+    while not (digest1.complete and digest2.complete):
+        for digest, iterator in ((digest1, iter1), (digest2, iter2)):
+            if not digest.complete:
+                batch = next(iterator, None)
+                if batch is None:
+                    digest.complete = True
+                    digest.end_run()
+                else:
+                    digest.add_rows(batch)
+        while digest1.runs and digest2.runs:
+            if digest1.runs.popleft() != digest2.runs.popleft():
+                order_mismatch = True
+                break
+        if order_mismatch:
+            break
+        # 行数或列数的差异已经确定时，不再继续读取
+        if (digest1.complete and digest2.rows > digest1.rows) or (digest2.complete and digest1.rows > digest2.rows):
+            break
+        if digest1.columns is not None and digest2.columns is not None and digest1.columns != digest2.columns:
+            break
+    equal = digest1.complete and digest2.complete and not order_mismatch and digest1.same_as(digest2)
+    return equal, digest1, digest2
+
+
+def Check(originResult: Result, mutatedResult: Result, isUpper: bool, isSame: bool,
+          order_columns: Optional[Sequence[int]] = None, comparator=None) -> Tuple[bool, str]:
+    """
+    order_columns: 不为None时按ORDER BY的顺序比较两个结果集（见Result.cmp_ordered）
+    comparator: 不为None时由comparator.cmp比较两个结果集（如columnar_check.ColumnarComparator），返回值与Result.cmp相同
+    """
+    if comparator is not None:
+        cmp, err = comparator.cmp(originResult, mutatedResult, order_columns)
+    else:
+        cmp, err = originResult.cmp(mutatedResult, order_columns)
     if err:
         return False, err
     # 相等，则满足oracle
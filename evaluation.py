@@ -21,19 +21,30 @@
 
 from __future__ import print_function
 import os
+import sys
 import json
 import sqlite3
+import glob
 import argparse
-import nltk
-from Tools.OracleChecker.oracle_check import execSQL_result_convertor, Result, Check
+import itertools
+import collections
+import multiprocessing
+import numpy as np
+from Tools.OracleChecker.oracle_check import Result, Check, RowNormalizer, stream_bag_equal
+from Tools.OracleChecker.columnar_check import ColumnarComparator
 from process_database_schema import load_database_table_schema
-from Tools.DatabaseConnect.database_connector import exec_sql_statement, database_clear
+from exec_cache import ExecResultCache
+from evaluation_scores import ScoresAccumulator, LEVEL, EXEC, EXACT
+from evaluation_stats import level_confidence_intervals, paired_bootstrap, mcnemar
+from evaluation_io import iter_eval_examples, iter_lines, iter_jsonl, MergedInfoWriter, SchemaSideFile, \
+    load_checkpoint, save_checkpoint, hardness_key, load_hardness_index
+from Tools.DatabaseConnect.database_connector import exec_sql_statement, exec_sql_on_file, \
+    get_exec_dbname, close_connection_pool, is_timeout_error, stream_sql_on_file
 import os
 import shutil
 
-nltk.download('punkt_tab')
-
-from process_sql import get_schema, Schema, get_sql
+from process_sql import SchemaRegistry, ParseCache, get_sql
+from sql_nodes import cond_unit_from_dict
 current_file_path = os.path.abspath(__file__)
 # 获取当前文件所在目录
 current_dir = os.path.dirname(current_file_path)
@@ -118,42 +129,36 @@ def get_scores(count, pred_total, label_total):
     return 0,0,0
 
 
+def count_matches(pred_units, label_units):
+    """number of pred units matched one-to-one with an equal label unit (size of the multiset intersection)"""
+    return sum((collections.Counter(pred_units) & collections.Counter(label_units)).values())
+
+
+def hashable_cond_unit(cond_unit):
+    # cond unit whose value is a nested sql dict -> hashable CondUnit, equal iff the nested sqls are equal
+    if type(cond_unit[3]) is dict or type(cond_unit[4]) is dict:
+        return cond_unit_from_dict(cond_unit)
+    return cond_unit
+
+
 def eval_sel(pred, label):
     pred_sel = pred['select'][1]
     label_sel = label['select'][1]
-    label_wo_agg = [unit[1] for unit in label_sel]
     pred_total = len(pred_sel)
     label_total = len(label_sel)
-    cnt = 0
-    cnt_wo_agg = 0
-
-    for unit in pred_sel:
-        if unit in label_sel:
-            cnt += 1
-            label_sel.remove(unit)
-        if unit[1] in label_wo_agg:
-            cnt_wo_agg += 1
-            label_wo_agg.remove(unit[1])
+    cnt = count_matches(pred_sel, label_sel)
+    cnt_wo_agg = count_matches([unit[1] for unit in pred_sel], [unit[1] for unit in label_sel])
 
     return label_total, pred_total, cnt, cnt_wo_agg
 
 
 def eval_where(pred, label):
-    pred_conds = [unit for unit in pred['where'][::2]]
-    label_conds = [unit for unit in label['where'][::2]]
-    label_wo_agg = [unit[2] for unit in label_conds]
+    pred_conds = [hashable_cond_unit(unit) for unit in pred['where'][::2]]
+    label_conds = [hashable_cond_unit(unit) for unit in label['where'][::2]]
     pred_total = len(pred_conds)
     label_total = len(label_conds)
-    cnt = 0
-    cnt_wo_agg = 0
-
-    for unit in pred_conds:
-        if unit in label_conds:
-            cnt += 1
-            label_conds.remove(unit)
-        if unit[2] in label_wo_agg:
-            cnt_wo_agg += 1
-            label_wo_agg.remove(unit[2])
+    cnt = count_matches(pred_conds, label_conds)
+    cnt_wo_agg = count_matches([unit[2] for unit in pred_conds], [unit[2] for unit in label_conds])
 
     return label_total, pred_total, cnt, cnt_wo_agg
 
@@ -163,13 +168,9 @@ def eval_group(pred, label):
     label_cols = [unit[1] for unit in label['groupBy']]
     pred_total = len(pred_cols)
     label_total = len(label_cols)
-    cnt = 0
     pred_cols = [pred.split(".")[1] if "." in pred else pred for pred in pred_cols]
     label_cols = [label.split(".")[1] if "." in label else label for label in label_cols]
-    for col in pred_cols:
-        if col in label_cols:
-            cnt += 1
-            label_cols.remove(col)
+    cnt = count_matches(pred_cols, label_cols)
     return label_total, pred_total, cnt
 
 
@@ -547,205 +548,425 @@ def print_scores(scores, etype, result_file):
                 file.write(partial_f1 + '\n')
 
 
-def evaluate(model, exp_id, gold, predict, acc, db_dir, etype, kmaps):
+def empty_sql():
+    # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
+    return {
+        "except": None,
+        "from": {
+            "conds": [],
+            "table_units": []
+        },
+        "groupBy": [],
+        "having": [],
+        "intersect": None,
+        "limit": None,
+        "orderBy": [],
+        "select": [
+            False,
+            []
+        ],
+        "union": None,
+        "where": []
+    }
+
+
+def eval_single(evaluator, schema_registry, p_str, g_str, db_name, db_dir, etype, kmaps, exec_exp='exp_2',
+                exec_mode='readonly', exec_timeout=None, exec_cache=None, parse_cache=None, hardness=None,
+                row_normalizer=None, exec_stream=False, result_sample=None, ignore_order=False, comparator=None):
+    """
+    评估单条predict/gold sql对：解析、rebuild、执行并比较结果、exact/partial match
+    parse_cache: ParseCache，相同schema下相同的sql只解析一次
+    hardness: gold sql的困难等级（来自hardness索引），为None时根据解析结果计算
+    row_normalizer: RowNormalizer，比较gold/predict执行结果时每行的规范化方式
+    exec_stream: 是否流式比较执行结果（见eval_exec_match_stream）
+    result_sample: 执行结果的result只保存前result_sample行，None时保存全部结果（流式比较时为STREAM_RESULT_SAMPLE行）
+    ignore_order: 为True时gold sql有ORDER BY也按多重集比较执行结果（不考虑顺序），见eval_exec_match
+    comparator: ColumnarComparator，不为None时按列向量化比较执行结果，见eval_exec_match
+    :return: dict，包含hardness、exec/exact得分、partial_scores以及gold/predict的执行结果
+    """
+    db = os.path.join(db_dir, db_name, db_name + ".sqlite")  # db的所在文件夹
+    schema = schema_registry.get(db)  # 获得db 的 schema
+    parse = parse_cache.get_sql if parse_cache is not None else get_sql
+    g_sql = parse(schema, g_str)  # 解析sql
+    if hardness is None:
+        hardness = evaluator.eval_hardness(g_sql)  # 评估其困难等级
+    p_sql_valid = True
+    try:
+        p_sql = parse(schema, p_str)
+    except:
+        p_sql = empty_sql()
+        p_sql_valid = False
+    # rebuild sql for value evaluation
+    kmap = kmaps[db_name]
+    g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
+    g_sql = rebuild_sql(g_valid_col_units, g_sql, kmap)
+    p_valid_col_units = build_valid_col_units(p_sql['from']['table_units'], schema)
+    p_sql = rebuild_sql(p_valid_col_units, p_sql, kmap)
+
+    result = {
+        "hardness": hardness,
+        "p_sql_valid": p_sql_valid,
+        "exec_score": False,
+        "gold_exec_result": None,
+        "predict_exec_result": None,
+        "exact_score": None,
+        "partial_scores": None
+    }
+    # 评估exec acc
+    if etype in ["all", "exec"]:
+        exec_score, gold_exec_result, predict_exec_result = eval_exec_match(db, p_str, g_str, p_sql, g_sql,
+                                                                            exec_exp, exec_mode, exec_timeout,
+                                                                            exec_cache, row_normalizer, exec_stream,
+                                                                            result_sample, ignore_order, comparator)
+        result["exec_score"] = exec_score
+        result["gold_exec_result"] = gold_exec_result
+        result["predict_exec_result"] = predict_exec_result
+
+    # 评估match acc
+    if etype in ["all", "match"]:
+        exact_score = evaluator.eval_exact_match(p_sql, g_sql)
+        if exact_score == 0:
+            print("{} pred: {}".format(hardness,p_str))
+            print("{} gold: {}".format(hardness,g_str))
+            print("")
+        result["exact_score"] = exact_score
+        result["partial_scores"] = evaluator.partial_scores
+    return result
+
+
+# 多进程评估时每个worker进程内的状态：schema、kmaps等只在进程初始化时加载一次
+_worker_state = {}
+
+
+def _init_eval_worker(db_dir, etype, kmaps, schema_cache, exec_mode, exec_timeout, exec_cache_file,
+                      parse_cache_file, row_normalizer, exec_stream, result_sample, ignore_order, comparator,
+                      exec_exp_prefix):
+    _worker_state["evaluator"] = Evaluator()
+    _worker_state["schema_registry"] = SchemaRegistry(schema_cache)
+    _worker_state["db_dir"] = db_dir
+    _worker_state["etype"] = etype
+    _worker_state["kmaps"] = kmaps
+    _worker_state["exec_mode"] = exec_mode
+    _worker_state["exec_timeout"] = exec_timeout
+    _worker_state["exec_cache"] = ExecResultCache(exec_cache_file) if exec_cache_file is not None else None
+    _worker_state["parse_cache"] = ParseCache(cache_file=parse_cache_file)
+    _worker_state["row_normalizer"] = row_normalizer
+    _worker_state["exec_stream"] = exec_stream
+    _worker_state["result_sample"] = result_sample
+    _worker_state["ignore_order"] = ignore_order
+    _worker_state["comparator"] = comparator
+    # 每个worker使用独立的sqlite执行文件，避免进程间互相覆盖
+    _worker_state["exec_exp"] = "{}_w{}".format(exec_exp_prefix, os.getpid())
+
+
+def _eval_example_group(group):
+    """在worker中评估一组(通常属于同一个db_id的)样例，返回[(样例下标, 评估结果), ...]"""
+    results = []
+    for idx, p_str, g_str, db_name, hardness in group:
+        result = eval_single(_worker_state["evaluator"], _worker_state["schema_registry"], p_str, g_str, db_name,
+                             _worker_state["db_dir"], _worker_state["etype"], _worker_state["kmaps"],
+                             _worker_state["exec_exp"], _worker_state["exec_mode"], _worker_state["exec_timeout"],
+                             _worker_state["exec_cache"], _worker_state["parse_cache"], hardness,
+                             _worker_state["row_normalizer"], _worker_state["exec_stream"],
+                             _worker_state["result_sample"], _worker_state["ignore_order"],
+                             _worker_state["comparator"])
+        results.append((idx, result))
+    # worker进程结束时不会执行清理，每组样例评估完后提交解析缓存和执行结果缓存
+    _worker_state["parse_cache"].flush()
+    if _worker_state["exec_cache"] is not None:
+        _worker_state["exec_cache"].flush()
+    return results
+
+
+def group_examples(examples, chunk_size):
+    """将连续的、db_id相同的样例划分为不超过chunk_size条的分组"""
+    group = []
+    for example in examples:
+        if group and (len(group) >= chunk_size or group[-1]["db_id"] != example["db_id"]):
+            yield group
+            group = []
+        group.append(example)
+    if group:
+        yield group
+
+
+def eval_parallel(examples, db_dir, etype, kmaps, workers, schema_cache=None, exec_mode='readonly',
+                  exec_timeout=None, exec_cache_file=None, parse_cache_file=None, row_normalizer=None, exec_stream=False,
+                  result_sample=None, ignore_order=False, comparator=None, chunk_size=16):
+    """
+    将连续的同一db_id的样例分组后分发到进程池中评估，每个worker内的schema和数据库连接保持warm。
+    同时在途的分组数不超过workers*2，内存占用与数据集大小无关。
+    :return: 生成器，按原始顺序返回(样例, 评估结果)
+    """
+    # sqlite执行文件名中带上本次评估的进程号，同时运行的其他评估的执行文件不会被清理
+    exec_exp_prefix = "exp_2_r{}".format(os.getpid())
+    with multiprocessing.Pool(workers, initializer=_init_eval_worker,
+                              initargs=(db_dir, etype, kmaps, schema_cache, exec_mode, exec_timeout,
+                                        exec_cache_file, parse_cache_file, row_normalizer, exec_stream,
+                                        result_sample, ignore_order, comparator, exec_exp_prefix)) as pool:
+        pending = collections.deque()
+        for group in group_examples(examples, chunk_size):
+            tasks = [(example["idx"], example["predict"], example["gold"], example["db_id"], example.get("hardness"))
+                     for example in group]
+            pending.append((group, pool.apply_async(_eval_example_group, (tasks,))))
+            # 按提交顺序取回结果，保证输出顺序与输入一致
+            while len(pending) >= workers * 2:
+                group, async_result = pending.popleft()
+                for example, (_, result) in zip(group, async_result.get()):
+                    yield example, result
+        while pending:
+            group, async_result = pending.popleft()
+            for example, (_, result) in zip(group, async_result.get()):
+                yield example, result
+    # 清理本次评估的各worker复制出的sqlite执行文件
+    for worker_file in glob.glob(os.path.join(current_dir, "Tools", "DatabaseConnect",
+                                              "spider1.0_{}_w*_sqlite.sqlite".format(exec_exp_prefix))):
+        os.remove(worker_file)
+
+
+def annotate_hardness(examples, hardness_index, hardness_levels, evaluator, schema_registry, db_dir,
+                      parse_cache=None):
+    """
+    从hardness索引中读取每条样例gold sql的困难等级，写入example["hardness"]（索引中没有时为None，评估时再计算）。
+    hardness_levels不为None时只保留这些困难等级的样例，索引中没有的样例需要解析gold sql来计算困难等级。
+    parse_cache: ParseCache，与eval_single共用，gold sql在这里解析后评估时不再重复解析
+    """
+    parse = parse_cache.get_sql if parse_cache is not None else get_sql
+    for example in examples:
+        entry = hardness_index.get(hardness_key(example["db_id"], example["gold"]))
+        example["hardness"] = entry[0] if entry is not None else None
+        if hardness_levels is None:
+            yield example
+            continue
+        if example["hardness"] is None:
+            db = os.path.join(db_dir, example["db_id"], example["db_id"] + ".sqlite")
+            example["hardness"] = evaluator.eval_hardness(parse(schema_registry.get(db), example["gold"]))
+        if example["hardness"] in hardness_levels:
+            yield example
+
+
+def print_confidence_intervals(intervals, etype, confidence, result_file):
+    """输出各困难等级exec/exact得分的bootstrap置信区间，intervals为level_confidence_intervals的返回值"""
+    levels = ['easy', 'medium', 'hard', 'extra', 'all']
+    names = []
+    if etype in ["all", "exec"]:
+        names.append("execution")
+    if etype in ["all", "match"]:
+        names.append("exact match")
+    with open(result_file, 'a') as file:
+        title = '\n================ {:.0%} BOOTSTRAP CONFIDENCE INTERVAL ================'.format(confidence)
+        print(title)
+        file.write(title + '\n')
+        for col, name in enumerate(names):
+            cells = ["-" if intervals[level] is None else "[{:.3f}, {:.3f}]".format(*intervals[level][col][1:])
+                     for level in levels]
+            line = "{:20} {:20} {:20} {:20} {:20} {:20}".format(name, *cells)
+            print(line)
+            file.write(line + '\n')
+
+
+def load_run_scores(merged_info_file):
+    """读取一次运行的merged_info.jsonl：id -> (db_id, query, exec_acc)"""
+    return {record["id"]: (record["db_id"], record["query"], bool(record["exec_acc"]))
+            for record in iter_jsonl(merged_info_file)}
+
+
+def compare_runs(merged_a, merged_b, result_file=None, n_resamples=10000, confidence=0.95, hardness_index_file=None,
+                 db_dir=None, schema_cache=None, parse_cache_file=None):
+    """
+    比较两次运行（如两个模型）在相同样例上的exec acc：按id配对，对每个困难等级做配对bootstrap检验和McNemar检验
+    困难等级来自hardness索引，索引中没有且给定db_dir时解析gold sql计算（通过schema_cache/parse_cache_file复用
+    评估时的schema和解析结果），否则只计入'all'
+    """
+    levels = ['easy', 'medium', 'hard', 'extra', 'all']
+    run_a = load_run_scores(merged_a)
+    run_b = load_run_scores(merged_b)
+    ids = [idx for idx in run_a if idx in run_b]
+    hardness_index = load_hardness_index(hardness_index_file) if hardness_index_file is not None else {}
+    evaluator = Evaluator()
+    schema_registry = SchemaRegistry(schema_cache)
+    parse_cache = ParseCache(cache_file=parse_cache_file)
+    level_idx = []
+    for idx in ids:
+        db_id, query, _ = run_a[idx]
+        entry = hardness_index.get(hardness_key(db_id, query))
+        hardness = entry[0] if entry is not None else None
+        if hardness is None and db_dir is not None:
+            try:
+                db = os.path.join(db_dir, db_id, db_id + ".sqlite")
+                hardness = evaluator.eval_hardness(parse_cache.get_sql(schema_registry.get(db), query))
+            except Exception:
+                hardness = None
+        level_idx.append(levels.index(hardness) if hardness is not None else -1)
+    parse_cache.close()
+    schema_registry.save()
+    level_idx = np.array(level_idx, dtype=np.int64)
+    a = np.array([run_a[idx][2] for idx in ids], dtype=np.float64)
+    b = np.array([run_b[idx][2] for idx in ids], dtype=np.float64)
+
+    lines = ["A: {}".format(merged_a), "B: {}".format(merged_b),
+             "paired examples: {}, only in A: {}, only in B: {}".format(len(ids), len(run_a) - len(ids),
+                                                                       len(run_b) - len(ids)),
+             "{:10} {:>6} {:>8} {:>8} {:>8} {:>20} {:>10} {:>6} {:>6} {:>10}".format(
+                 "", "count", "exec A", "exec B", "A - B", "{:.0%} CI".format(confidence), "p(boot)", "A>B", "B>A",
+                 "p(McNemar)")]
+    for i, level in enumerate(levels):
+        mask = np.ones(len(ids), dtype=bool) if level == 'all' else level_idx == i
+        if not mask.any():
+            continue
+        boot = paired_bootstrap(a[mask], b[mask], n_resamples, 1 - confidence, seed=i)
+        test = mcnemar(a[mask], b[mask])
+        lines.append("{:10} {:>6d} {:>8.3f} {:>8.3f} {:>+8.3f} {:>20} {:>10.4f} {:>6d} {:>6d} {:>10.4f}".format(
+            level, boot["n"], a[mask].mean(), b[mask].mean(), boot["diff"],
+            "[{:+.3f}, {:+.3f}]".format(boot["low"], boot["high"]), boot["p_value"], test["n10"], test["n01"],
+            test["p_value"]))
+    for line in lines:
+        print(line)
+    if result_file is not None:
+        with open(result_file, 'a') as file:
+            file.write("\n".join(lines) + "\n")
+
+
+def evaluate(model, exp_id, gold, predict, acc, db_dir, etype, kmaps, schema_cache=None, workers=1,
+             exec_mode='readonly', exec_timeout=None, flush_every=100, fsync=False, schema_ref=False, restart=False,
+             exec_cache_file=None, parse_cache_file=None, hardness_index_file=None, hardness_levels=None,
+             db_scores_file=None, bootstrap=0, confidence=0.95, row_normalizer=None, exec_stream=False,
+             result_sample=None, ignore_order=False, comparator=None):
     output_dic = os.path.join(current_dir, "Output", (model+"_"+str(exp_id)).lower())
     detailed_gold_info_file = os.path.join(output_dic, "detailed_gold_info.jsonl")
     detailed_llm_info_file = os.path.join(output_dic, "predict.jsonl")
     merged_info_file = os.path.join(output_dic, "merged_info.jsonl")
-
-    with open(detailed_gold_info_file, "r", encoding="utf-8") as r:
-        lines = r.readlines()
-    with open(detailed_llm_info_file, "r", encoding="utf-8") as r:
-        lines_llm = r.readlines()
+    schemas_file = os.path.join(output_dic, "schemas.jsonl")
+    checkpoint_file = os.path.join(output_dic, "merged_info.ckpt.json")
+    scores_file = os.path.join(output_dic, "merged_info.scores.bin")
 
     if os.path.exists(acc):
         print(acc+"has been exist.")
         return
-    with open(gold) as f:
-        glist = [l.strip().split('\t') for l in f.readlines() if len(l.strip()) > 0]
-
-    with open(predict) as f:
-        plist = [l.strip().split('\t') for l in f.readlines() if len(l.strip()) > 0]
-    # plist = [("select max(Share),min(Share) from performance where Type != 'terminal'")]
-    # glist = [("SELECT max(SHARE) ,  min(SHARE) FROM performance WHERE TYPE != 'Live final'", "orchestra")]
+    # 四个输入文件按行惰性对齐读取，每次只有一条样例在内存中
+    examples = iter_eval_examples(gold, predict, detailed_gold_info_file, detailed_llm_info_file)
     evaluator = Evaluator()
+    schema_registry = SchemaRegistry(schema_cache)  # 每个db的schema只解析一次，可持久化到schema_cache
 
     levels = ['easy', 'medium', 'hard', 'extra', 'all']
     partial_types = ['select', 'select(no AGG)', 'where', 'where(no OP)', 'group(no Having)',
                      'group', 'order', 'and/or', 'IUEN', 'keywords']
-    entries = []
-    scores = {}  # 记录不同难度等级的测试数据的acc，rec，f1，acc_count,rec_count
-
-    # 初始化scores字典
-    for level in levels:
-        scores[level] = {'count': 0, 'partial': {}, 'exact': 0.}
-        scores[level]['exec'] = 0
-        for type_ in partial_types:
-            scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
-
+    # 每条样例的得分按行记录在numpy数组中，评估结束时汇总
+    scores = ScoresAccumulator(levels, partial_types, etype)
     eval_err_num = 0
-    CNT = 0
-    # 评估所有测试结果
-    for p, g in zip(plist, glist):
-        p_str = p[0] # predict sql string
-        g_str, db = g # g_str为gold sql string, db 为db_id
-        db_name = db
-        db = os.path.join(db_dir, db, db + ".sqlite")  # db的所在文件夹
-        schema = Schema(get_schema(db))  # 获得db 的 schema
-        g_sql = get_sql(schema, g_str)  # 解析sql
-        hardness = evaluator.eval_hardness(g_sql)  # 评估其困难等级
-        scores[hardness]['count'] += 1
-        scores['all']['count'] += 1
-        try:
-            p_sql = get_sql(schema, p_str)
-        except:
-            # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
-            p_sql = {
-            "except": None,
-            "from": {
-                "conds": [],
-                "table_units": []
-            },
-            "groupBy": [],
-            "having": [],
-            "intersect": None,
-            "limit": None,
-            "orderBy": [],
-            "select": [
-                False,
-                []
-            ],
-            "union": None,
-            "where": []
-            }
-            eval_err_num += 1
-            print("eval_err_num:{}".format(eval_err_num))
-        # rebuild sql for value evaluation
-        kmap = kmaps[db_name]
-        g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
-        g_sql = rebuild_sql_val(g_sql)
-        g_sql = rebuild_sql_col(g_valid_col_units, g_sql, kmap)
-        p_valid_col_units = build_valid_col_units(p_sql['from']['table_units'], schema)
-        p_sql = rebuild_sql_val(p_sql)
-        p_sql = rebuild_sql_col(p_valid_col_units, p_sql, kmap)
-
-        # 评估exec acc
-        gold_result_str = ""
-        predict_result_str = ""
-        exec_score = False
-        if etype in ["all", "exec"]:
-            # exec_score, gold_result, predict_result = eval_exec_match(db, p_str, g_str, p_sql, g_sql)
-            exec_score,gold_exec_result, predict_exec_result = eval_exec_match(db, p_str, g_str, p_sql, g_sql)
-
-            if exec_score:
-                scores[hardness]['exec'] += 1.0
-                scores['all']['exec'] += 1.0
-            """
-            print(str(CNT))
-            print(exec_score)
-            print(gold_result_str)
-            print(predict_result_str)
-            """
-
-            """
-            # 将执行结果存储
-            exec_results_file = acc.replace(".txt", ".jsonl")
-            if not os.path.exists(exec_results_file):
-                with open(exec_results_file, 'w') as file:
-                    pass
-            with open(exec_results_file, 'a') as file:
-                json.dump({"gold_exec_result":str(gold_result), "predict_exec_result":str(predict_result)}, file)
-                file.write('\n')
-            """
-
-        # 评估match acc
-        if etype in ["all", "match"]:
-            exact_score = evaluator.eval_exact_match(p_sql, g_sql)
-            partial_scores = evaluator.partial_scores
-            if exact_score == 0:
-                print("{} pred: {}".format(hardness,p_str))
-                print("{} gold: {}".format(hardness,g_str))
-                print("")
-            scores[hardness]['exact'] += exact_score
-            scores['all']['exact'] += exact_score
-            for type_ in partial_types:
-                if partial_scores[type_]['pred_total'] > 0:
-                    scores[hardness]['partial'][type_]['acc'] += partial_scores[type_]['acc']
-                    scores[hardness]['partial'][type_]['acc_count'] += 1
-                if partial_scores[type_]['label_total'] > 0:
-                    scores[hardness]['partial'][type_]['rec'] += partial_scores[type_]['rec']
-                    scores[hardness]['partial'][type_]['rec_count'] += 1
-                scores[hardness]['partial'][type_]['f1'] += partial_scores[type_]['f1']
-                if partial_scores[type_]['pred_total'] > 0:
-                    scores['all']['partial'][type_]['acc'] += partial_scores[type_]['acc']
-                    scores['all']['partial'][type_]['acc_count'] += 1
-                if partial_scores[type_]['label_total'] > 0:
-                    scores['all']['partial'][type_]['rec'] += partial_scores[type_]['rec']
-                    scores['all']['partial'][type_]['rec_count'] += 1
-                scores['all']['partial'][type_]['f1'] += partial_scores[type_]['f1']
-
-            entries.append({
-                'predictSQL': p_str,
-                'goldSQL': g_str,
-                'hardness': hardness,
-                'exact': exact_score,
-                'partial': partial_scores
-            })
-
-
-        # 评估完一条，将其所有结果进行汇总："db_id"， "question"，"query"，"predict","gold_exec_result","predict_exec_result"
-        info = json.loads(lines[CNT])
-        info_llm = json.loads(lines_llm[CNT])
-
-        merged_eval_result = {
-            "id": info["id"],
-            "db_id":info["db_id"],
-            "tables":load_database_table_schema(info["db_id"]),
-            "question":info["question"],
-            "query":info["query"],
-            "predict":p_str,
-            "gold_exec_result":gold_exec_result,
-            "predict_exec_result":predict_exec_result,
-            "exec_acc":exec_score
-        }
-        if "explanation" in info_llm:
-            merged_eval_result["llm_explanation"] = info_llm["explanation"]
-
-        # 将合并的结果存储
-        if not os.path.exists(merged_info_file):
-            with open(merged_info_file, 'w') as file:
-                pass
-        with open(merged_info_file, 'a') as file:
-            json.dump(merged_eval_result, file)
-            file.write('\n')
-        CNT += 1
-
-    for level in levels:
-        if scores[level]['count'] == 0:
-            continue
-        if etype in ["all", "exec"]:
-            scores[level]['exec'] /= scores[level]['count']
 
-        if etype in ["all", "match"]:
-            scores[level]['exact'] /= scores[level]['count']
-            for type_ in partial_types:
-                if scores[level]['partial'][type_]['acc_count'] == 0:
-                    scores[level]['partial'][type_]['acc'] = 0
-                else:
-                    scores[level]['partial'][type_]['acc'] = scores[level]['partial'][type_]['acc'] / \
-                                                             scores[level]['partial'][type_]['acc_count'] * 1.0
-                if scores[level]['partial'][type_]['rec_count'] == 0:
-                    scores[level]['partial'][type_]['rec'] = 0
-                else:
-                    scores[level]['partial'][type_]['rec'] = scores[level]['partial'][type_]['rec'] / \
-                                                             scores[level]['partial'][type_]['rec_count'] * 1.0
-                if scores[level]['partial'][type_]['acc'] == 0 and scores[level]['partial'][type_]['rec'] == 0:
-                    scores[level]['partial'][type_]['f1'] = 1
-                else:
-                    scores[level]['partial'][type_]['f1'] = \
-                        2.0 * scores[level]['partial'][type_]['acc'] * scores[level]['partial'][type_]['rec'] / (
-                        scores[level]['partial'][type_]['rec'] + scores[level]['partial'][type_]['acc'])
-    print_scores(scores, etype, acc)
+    # 从checkpoint恢复：跳过已完成的样例，恢复scores，并丢弃merged_info.jsonl中checkpoint之后写入的记录
+    checkpoint = None if restart else load_checkpoint(checkpoint_file)
+    start_idx = 0
+    merged_offset = 0
+    if checkpoint is not None:
+        start_idx = checkpoint["next_idx"]
+        scores.restore(scores_file, checkpoint["scores_rows"], checkpoint["db_ids"])
+        eval_err_num = checkpoint["eval_err_num"]
+        merged_offset = checkpoint["merged_offset"]
+        print("resume from checkpoint {}: example {}".format(checkpoint_file, start_idx))
+        examples = itertools.islice(examples, start_idx, None)
+    else:
+        ScoresAccumulator.remove_checkpoint(scores_file)
+
+    # hardness索引：gold集合的困难等级由hardness_index.py预先计算，评估时不再重新计算；
+    # hardness_levels只评估指定困难等级的样例（如只评估extra）
+    # 解析缓存：相同的sql只解析一次，设置parse_cache_file时解析结果在多次运行之间（以及与worker之间）复用
+    parse_cache = ParseCache(cache_file=parse_cache_file)
+    if hardness_index_file is not None or hardness_levels is not None:
+        hardness_index = load_hardness_index(hardness_index_file) if hardness_index_file is not None else {}
+        examples = annotate_hardness(examples, hardness_index, hardness_levels, evaluator, schema_registry, db_dir,
+                                     parse_cache)
+
+    exec_cache = None
+    if workers > 1:
+        # 先在主进程中把所有db的schema写入缓存文件，worker启动后直接读取
+        if schema_cache is not None:
+            for db_name in set(line.split('\t')[1] for line in iter_lines(gold)):
+                schema_registry.get(os.path.join(db_dir, db_name, db_name + ".sqlite"))
+            schema_registry.save()
+        results = eval_parallel(examples, db_dir, etype, kmaps, workers, schema_cache, exec_mode, exec_timeout,
+                                exec_cache_file, parse_cache_file, row_normalizer, exec_stream, result_sample,
+                                ignore_order, comparator)
+    else:
+        # 执行结果缓存：相同的sql在不同模型/实验之间的执行结果直接复用
+        exec_cache = ExecResultCache(exec_cache_file) if exec_cache_file is not None else None
+        results = ((example, eval_single(evaluator, schema_registry, example["predict"], example["gold"],
+                                         example["db_id"], db_dir, etype, kmaps, exec_mode=exec_mode,
+                                         exec_timeout=exec_timeout, exec_cache=exec_cache, parse_cache=parse_cache,
+                                         hardness=example.get("hardness"), row_normalizer=row_normalizer,
+                                         exec_stream=exec_stream, result_sample=result_sample,
+                                         ignore_order=ignore_order, comparator=comparator))
+                   for example in examples)
+
+    # merged_info.jsonl在整个评估过程中只打开一次，每flush_every条写入一次并记录checkpoint
+    merged_writer = MergedInfoWriter(merged_info_file, batch_size=flush_every, fsync=fsync, truncate_to=merged_offset)
+    # schema_ref模式下，每个db的schema只写入一次schemas.jsonl，merged记录中通过db_id引用
+    schema_side_file = SchemaSideFile(schemas_file) if schema_ref else None
+    since_checkpoint = 0  # 上次checkpoint之后处理的样例数
+    try:
+        # 评估所有测试结果，并按原始顺序汇总得分
+        for example, result in results:
+            if not result["p_sql_valid"]:
+                eval_err_num += 1
+                print("eval_err_num:{}".format(eval_err_num))
+            scores.add(result, example["db_id"])
+
+            # 评估完一条，将其所有结果进行汇总："db_id"， "question"，"query"，"predict","gold_exec_result","predict_exec_result"
+            info = example["info"]
+            info_llm = example["info_llm"]
+
+            merged_eval_result = {
+                "id": info["id"],
+                "db_id":info["db_id"],
+                "tables":load_database_table_schema(info["db_id"]),
+                "question":info["question"],
+                "query":info["query"],
+                "predict":example["predict"],
+                "gold_exec_result":result["gold_exec_result"],
+                "predict_exec_result":result["predict_exec_result"],
+                "exec_acc":result["exec_score"]
+            }
+            if "explanation" in info_llm:
+                merged_eval_result["llm_explanation"] = info_llm["explanation"]
+            if schema_side_file is not None:
+                schema_side_file.add(info["db_id"], merged_eval_result.pop("tables"))
+
+            # 将合并的结果存储
+            merged_writer.write(merged_eval_result)
+            # 按处理的样例数记录checkpoint：按hardness_levels过滤时被跳过的样例不计入，idx不一定连续
+            since_checkpoint += 1
+            if since_checkpoint >= flush_every:
+                since_checkpoint = 0
+                save_checkpoint(checkpoint_file, {
+                    "next_idx": example["idx"] + 1,
+                    "scores_rows": scores.checkpoint(scores_file),
+                    "db_ids": scores.db_ids,
+                    "eval_err_num": eval_err_num,
+                    "merged_offset": merged_writer.checkpoint()
+                })
+    finally:
+        merged_writer.close()
+        if exec_cache is not None:
+            exec_cache.close()
+        if parse_cache is not None:
+            parse_cache.close()
+    schema_registry.save()
+
+    print_scores(scores.scores(), etype, acc)
+    if db_scores_file is not None:
+        with open(db_scores_file, "w", encoding="utf-8") as w:
+            json.dump(scores.db_scores(), w, indent=4)
+    if bootstrap > 0:
+        # 各困难等级exec/exact得分的bootstrap置信区间
+        columns = [col for col, type_ in [(EXEC, "exec"), (EXACT, "match")] if etype in ["all", type_]]
+        rows = scores.rows
+        intervals = level_confidence_intervals(rows[:, LEVEL], rows[:, columns], levels, bootstrap, 1 - confidence)
+        print_confidence_intervals(intervals, etype, confidence, acc)
+    # 评估完成，acc文件已生成，不再需要checkpoint
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    ScoresAccumulator.remove_checkpoint(scores_file)
 
 
 # def eval_exec_match(db, p_str, g_str, pred, gold):
@@ -802,21 +1023,163 @@ def evaluate(model, exp_id, gold, predict, acc, db_dir, etype, kmaps):
 #     # return res_map(p_res, p_val_units) == res_map(g_res, g_val_units), str(g_res), str(p_res)
 
 
-def eval_exec_match(db, p_str, g_str, pred, gold):
+# copy模式下每个exp当前复制的源db，同一个db的样例复用同一份拷贝
+_exec_db_copies = {}
+
+
+def is_read_only_sql(sql_str):
+    return sql_str.strip().lstrip('(').upper().startswith(('SELECT', 'WITH'))
+
+
+def exec_status(error_message):
+    if error_message is None:
+        return "ok"
+    if is_timeout_error(error_message):
+        return "timeout"
+    return "error"
+
+
+def cached_exec(exec_cache, db, sql_str, execute):
     """
-    return 1 if the values between prediction and gold are matching
-    in the corresponding index. Currently not support multiple col_unit(pairs).
+    先查询执行结果缓存，未命中时调用execute执行sql并写入缓存。
+    只缓存只读sql，超时和数据库崩溃的结果不缓存。
+    :return: result, exec_time, error_message, cached
+             cached为True时结果来自缓存，exec_time是该sql首次执行时记录的时间，不是本次运行的耗时
     """
+    cacheable = exec_cache is not None and is_read_only_sql(sql_str)
+    if cacheable:
+        cached = exec_cache.get(db, sql_str)
+        if cached is not None:
+            return cached + (True,)
+    res, exec_time, error_message, crash_detected = execute(sql_str)
+    if cacheable and not crash_detected and not is_timeout_error(error_message):
+        exec_cache.put(db, sql_str, res, exec_time, error_message)
+    return res, exec_time, error_message, False
+
+
+def order_by_columns(sql):
+    """
+    sql的ORDER BY中各排序项在SELECT中的下标，用于按顺序比较执行结果。
+    没有ORDER BY，或有排序项不在SELECT中（无法从结果判断哪些行的排序列的值相同）时返回None，按多重集比较
+    """
+    if len(sql['orderBy']) == 0:
+        return None
+
+    def freeze(val_unit):
+        unit_op, col_unit1, col_unit2 = val_unit
+        return unit_op, tuple(col_unit1), tuple(col_unit2) if col_unit2 is not None else None
+
+    select_units = []
+    for agg_id, val_unit in sql['select'][1]:
+        unit_op, col_unit1, col_unit2 = freeze(val_unit)
+        # SELECT中的聚合记在外层（如count(*)为(3, (0, (0, '__all__', ..), None))），ORDER BY中记在col_unit上
+        if agg_id != 0 and unit_op == 0 and col_unit2 is None:
+            col_unit1 = (agg_id,) + col_unit1[1:]
+        select_units.append((unit_op, col_unit1, col_unit2))
+    columns = []
+    for val_unit in sql['orderBy'][1]:
+        val_unit = freeze(val_unit)
+        if val_unit not in select_units:
+            return None
+        columns.append(select_units.index(val_unit))
+    return columns
+
+
+# 流式比较时执行结果默认只保存的行数
+STREAM_RESULT_SAMPLE = 20
+
+
+def eval_exec_match_stream(db, p_str, g_str, timeout=None, exec_cache=None, row_normalizer=None, sample_size=None,
+                           order_columns=None):
+    """
+    流式比较gold/predict的执行结果（只读sql，readonly模式）：两条sql的结果交替按批读取并增量计算顺序无关的摘要，
+    行数的差异确定后（如predict缺少join条件返回了大量结果行）立即停止读取，内存占用与结果行数无关。
+    缓存中已有的执行结果直接使用，流式执行的结果不写入缓存。
+    执行结果中result只保存前sample_size行（默认STREAM_RESULT_SAMPLE行），fingerprint为读取时增量计算的摘要，
+    提前结束读取时其complete为False
+    order_columns: 不为None时按ORDER BY的顺序比较（见order_by_columns），遇到第一处不同即停止读取
+    """
+    if row_normalizer is None:
+        row_normalizer = RowNormalizer()
+    if sample_size is None:
+        sample_size = STREAM_RESULT_SAMPLE
+    executions = []
+    for sql_str in (g_str, p_str):
+        cached = exec_cache.get(db, sql_str) if exec_cache is not None else None
+        if cached is not None:
+            res, exec_time, error_message = cached
+            executions.append((None, [res] if res else [], exec_time, error_message, True))
+        else:
+            stream = stream_sql_on_file(db, 'sqlite', sql_str, timeout=timeout)
+            executions.append((stream, stream.batches(), None, None, False))
+    equal, g_digest, p_digest = stream_bag_equal(executions[0][1], executions[1][1], row_normalizer, sample_size,
+                                                 order_columns)
+
+    exec_results = []
+    for (stream, _, exec_time, error_message, cached), digest in zip(executions, (g_digest, p_digest)):
+        if stream is not None:
+            stream.close()  # 提前结束时释放未读完的结果
+            exec_time, error_message = stream.exec_time, stream.error_message
+        exec_results.append({
+            "result": str(digest.sample) if error_message is None else str(None),
+            "fingerprint": digest.to_dict() if error_message is None else None,
+            "exec_time": exec_time,
+            "cached": cached,
+            "error_message": error_message,
+            "exec_able": True if error_message == None else False,
+            "status": exec_status(error_message)
+        })
+    g_exec_result, p_exec_result = exec_results
+    oracle_check = equal and g_exec_result["exec_able"] and p_exec_result["exec_able"]
+    return oracle_check, g_exec_result, p_exec_result
 
-    # 将对应的db复制到当前文件夹下
-    source_sqlite_file = db
-    target_sqlite_file = os.path.join(current_dir, "Tools", "DatabaseConnect", "spider1.0_exp_2_sqlite.sqlite")
-    shutil.copy2(source_sqlite_file, target_sqlite_file)  # 使用 copy2 保留文件的元数据（如时间戳等）
-
-    g_res, g_exec_time, g_error_message, _ = exec_sql_statement("spider1.0",'exp_2','sqlite', g_str)
-    p_res, p_exec_time, p_error_message, _ = exec_sql_statement("spider1.0", 'exp_2', 'sqlite', p_str)
 
-    database_clear("spider1.0", 'exp_2', 'sqlite')
+def eval_exec_match(db, p_str, g_str, pred, gold, exp='exp_2', exec_mode='readonly', timeout=None, exec_cache=None,
+                    row_normalizer=None, exec_stream=False, result_sample=None, ignore_order=False,
+                    comparator=None):
+    """
+    return 1 if the values between prediction and gold are matching
+    in the corresponding index. Currently not support multiple col_unit(pairs).
+    exec_mode: 'readonly'直接以只读方式打开原始db执行；'copy'将db复制一份后执行，同一个db只复制一次
+    timeout: 单条sql的执行超时时间（秒），超时的sql会被中断，其执行结果的status为"timeout"
+    exec_cache: ExecResultCache，gold sql和predict sql的执行结果优先从缓存中读取，
+                不同模型/实验中规范化后相同的sql在同一个db上只执行一次
+    row_normalizer: RowNormalizer，比较时直接对原生的结果行生成key，默认按str(value)比较
+    exec_stream: readonly模式下gold和predict都是只读sql时，使用eval_exec_match_stream流式比较
+    result_sample: 不为None时执行结果的result只保存前result_sample行，完整结果集由fingerprint表示
+    ignore_order: gold sql的ORDER BY的排序项都在SELECT中时，默认按顺序比较执行结果（排序列的值相同的行之间不考虑顺序），
+                  为True时仍按多重集比较
+    comparator: ColumnarComparator，不为None时按列转换为numpy数组后比较执行结果，混合类型的结果回退到逐行比较；
+                流式比较时不使用
+    """
+    order_columns = None if ignore_order else order_by_columns(gold)
+    if exec_stream and exec_mode == 'readonly' and is_read_only_sql(g_str) and is_read_only_sql(p_str):
+        return eval_exec_match_stream(db, p_str, g_str, timeout, exec_cache, row_normalizer, result_sample,
+                                      order_columns)
+
+    if exec_mode == 'readonly':
+        g_res, g_exec_time, g_error_message, g_cached = cached_exec(
+            exec_cache, db, g_str, lambda sql_str: exec_sql_on_file(db, 'sqlite', sql_str, timeout=timeout))
+        p_res, p_exec_time, p_error_message, p_cached = cached_exec(
+            exec_cache, db, p_str, lambda sql_str: exec_sql_on_file(db, 'sqlite', sql_str, timeout=timeout))
+    else:
+        # 将对应的db复制到当前文件夹下（仅在db变化或上一条sql可能修改了数据时重新复制）
+        source_sqlite_file = db
+        target_sqlite_file = os.path.join(current_dir, "Tools", "DatabaseConnect", "spider1.0_{}_sqlite.sqlite".format(exp))
+        if _exec_db_copies.get(exp) != source_sqlite_file or not os.path.exists(target_sqlite_file):
+            close_connection_pool('sqlite', get_exec_dbname("spider1.0", exp, 'sqlite'))  # 覆盖文件前释放复用的连接
+            shutil.copy2(source_sqlite_file, target_sqlite_file)  # 使用 copy2 保留文件的元数据（如时间戳等）
+            _exec_db_copies[exp] = source_sqlite_file
+
+        g_res, g_exec_time, g_error_message, g_cached = cached_exec(
+            exec_cache, db, g_str, lambda sql_str: exec_sql_statement("spider1.0", exp, 'sqlite', sql_str, timeout))
+        # gold sql修改了复制的db时，predict sql的执行结果与原始db不对应，不能使用缓存
+        p_res, p_exec_time, p_error_message, p_cached = cached_exec(
+            exec_cache if is_read_only_sql(g_str) else None, db, p_str,
+            lambda sql_str: exec_sql_statement("spider1.0", exp, 'sqlite', sql_str, timeout))
+
+        if not is_read_only_sql(g_str) or not is_read_only_sql(p_str):
+            _exec_db_copies.pop(exp, None)
 
     def res_map(res, val_units):
         rmap = {}
@@ -837,28 +1200,33 @@ def eval_exec_match(db, p_str, g_str, pred, gold):
     """
 
     # 下面对比错误
-    g_check_result = execSQL_result_convertor(g_res)
-    p_check_result = execSQL_result_convertor(p_res)
-    g_result_object = Result(g_check_result["column_names"],
-                                  g_check_result["column_types"],
-                                  g_check_result["rows"])
-    p_result_object = Result(p_check_result["column_names"],
-                                 p_check_result["column_types"],
-                                 p_check_result["rows"])
-
-    oracle_check, error = Check(g_result_object, p_result_object, True,True)  # check result->another_result是否符合is_upper
+    if row_normalizer is None:
+        row_normalizer = RowNormalizer()
+    # 顺序无关的结果指纹，不同运行之间可以直接按指纹判断结果集是否相同；在比较生成行key的同一遍中计算
+    g_result_object = Result.from_rows(g_res, row_normalizer, fingerprint=True)
+    p_result_object = Result.from_rows(p_res, row_normalizer, fingerprint=True)
+
+    oracle_check, error = Check(g_result_object, p_result_object, True, True, order_columns, comparator)  # check result->another_result是否符合is_upper
+    g_fingerprint = g_result_object.fingerprint() if g_res is not None else None
+    p_fingerprint = p_result_object.fingerprint() if p_res is not None else None
     g_exec_result = {
-        "result": str(g_res),
+        "result": str(g_res) if result_sample is None or g_res is None else str(g_res[:result_sample]),
+        "fingerprint": g_fingerprint.to_dict() if g_fingerprint is not None else None,
         "exec_time":g_exec_time,
+        "cached": g_cached,
         "error_message":g_error_message,
-        "exec_able": True if g_error_message == None else False
+        "exec_able": True if g_error_message == None else False,
+        "status": exec_status(g_error_message)
     }
 
     p_exec_result = {
-        "result": str(p_res),
+        "result": str(p_res) if result_sample is None or p_res is None else str(p_res[:result_sample]),
+        "fingerprint": p_fingerprint.to_dict() if p_fingerprint is not None else None,
         "exec_time": p_exec_time,
+        "cached": p_cached,
         "error_message": p_error_message,
-        "exec_able": True if p_error_message == None else False
+        "exec_able": True if p_error_message == None else False,
+        "status": exec_status(p_error_message)
     }
 
     if g_exec_result["exec_able"] == False or p_exec_result["exec_able"] == False:
@@ -867,160 +1235,90 @@ def eval_exec_match(db, p_str, g_str, pred, gold):
     # return res_map(p_res, p_val_units) == res_map(g_res, g_val_units), str(g_res), str(p_res)
 
 
-# Rebuild SQL functions for value evaluation
-def rebuild_cond_unit_val(cond_unit):
-    if cond_unit is None or not DISABLE_VALUE:
-        return cond_unit
-
-    not_op, op_id, val_unit, val1, val2 = cond_unit
-    if type(val1) is not dict:
-        val1 = None
-    else:
-        val1 = rebuild_sql_val(val1)
-    if type(val2) is not dict:
-        val2 = None
-    else:
-        val2 = rebuild_sql_val(val2)
-    return not_op, op_id, val_unit, val1, val2
-
-
-def rebuild_condition_val(condition):
-    if condition is None or not DISABLE_VALUE:
-        return condition
-
-    res = []
-    for idx, it in enumerate(condition):
-        if idx % 2 == 0:
-            res.append(rebuild_cond_unit_val(it))
-        else:
-            res.append(it)
-    return res
-
-
-def rebuild_sql_val(sql):
-    if sql is None or not DISABLE_VALUE:
-        return sql
-
-    sql['from']['conds'] = rebuild_condition_val(sql['from']['conds'])
-    sql['having'] = rebuild_condition_val(sql['having'])
-    sql['where'] = rebuild_condition_val(sql['where'])
-    sql['intersect'] = rebuild_sql_val(sql['intersect'])
-    sql['except'] = rebuild_sql_val(sql['except'])
-    sql['union'] = rebuild_sql_val(sql['union'])
-
-    return sql
-
-
 # Rebuild SQL functions for foreign key evaluation
 def build_valid_col_units(table_units, schema):
     col_ids = [table_unit[1] for table_unit in table_units if table_unit[0] == TABLE_TYPE['table_unit']]
     prefixs = [col_id[:-2] for col_id in col_ids]
     valid_col_units= []
-    for value in schema.idMap.values():
-        if '.' in value and value[:value.index('.')] in prefixs:
-            valid_col_units.append(value)
+    for prefix in dict.fromkeys(prefixs):
+        valid_col_units.extend(schema.tableCols.get(prefix, []))
     return valid_col_units
 
 
-def rebuild_col_unit_col(valid_col_units, col_unit, kmap):
-    if col_unit is None:
-        return col_unit
-
-    agg_id, col_id, distinct = col_unit
-    if col_id in kmap and col_id in valid_col_units:
-        col_id = kmap[col_id]
-    if DISABLE_DISTINCT:
-        distinct = None
-    return agg_id, col_id, distinct
-
-
-def rebuild_val_unit_col(valid_col_units, val_unit, kmap):
-    if val_unit is None:
-        return val_unit
-
-    unit_op, col_unit1, col_unit2 = val_unit
-    col_unit1 = rebuild_col_unit_col(valid_col_units, col_unit1, kmap)
-    col_unit2 = rebuild_col_unit_col(valid_col_units, col_unit2, kmap)
-    return unit_op, col_unit1, col_unit2
-
-
-def rebuild_table_unit_col(valid_col_units, table_unit, kmap):
-    if table_unit is None:
-        return table_unit
-
-    table_type, col_unit_or_sql = table_unit
-    if isinstance(col_unit_or_sql, tuple):
-        col_unit_or_sql = rebuild_col_unit_col(valid_col_units, col_unit_or_sql, kmap)
-    return table_type, col_unit_or_sql
-
-
-def rebuild_cond_unit_col(valid_col_units, cond_unit, kmap):
-    if cond_unit is None:
-        return cond_unit
-
-    not_op, op_id, val_unit, val1, val2 = cond_unit
-    val_unit = rebuild_val_unit_col(valid_col_units, val_unit, kmap)
-    return not_op, op_id, val_unit, val1, val2
-
-
-def rebuild_condition_col(valid_col_units, condition, kmap):
-    for idx in range(len(condition)):
-        if idx % 2 == 0:
-            condition[idx] = rebuild_cond_unit_col(valid_col_units, condition[idx], kmap)
-    return condition
-
-
-def rebuild_select_col(valid_col_units, sel, kmap):
-    if sel is None:
-        return sel
-    distinct, _list = sel
-    new_list = []
-    for it in _list:
-        agg_id, val_unit = it
-        new_list.append((agg_id, rebuild_val_unit_col(valid_col_units, val_unit, kmap)))
-    if DISABLE_DISTINCT:
-        distinct = None
-    return distinct, new_list
-
-
-def rebuild_from_col(valid_col_units, from_, kmap):
-    if from_ is None:
-        return from_
-
-    from_['table_units'] = [rebuild_table_unit_col(valid_col_units, table_unit, kmap) for table_unit in from_['table_units']]
-    from_['conds'] = rebuild_condition_col(valid_col_units, from_['conds'], kmap)
-    return from_
-
-
-def rebuild_group_by_col(valid_col_units, group_by, kmap):
-    if group_by is None:
-        return group_by
-
-    return [rebuild_col_unit_col(valid_col_units, col_unit, kmap) for col_unit in group_by]
-
-
-def rebuild_order_by_col(valid_col_units, order_by, kmap):
-    if order_by is None or len(order_by) == 0:
-        return order_by
-
-    direction, val_units = order_by
-    new_val_units = [rebuild_val_unit_col(valid_col_units, val_unit, kmap) for val_unit in val_units]
-    return direction, new_val_units
-
-
-def rebuild_sql_col(valid_col_units, sql, kmap):
+# Rebuild SQL for value and foreign key evaluation
+def rebuild_sql(valid_col_units, sql, kmap):
+    """
+    Normalize the sql for comparison in one walk: with DISABLE_VALUE the values in conditions are
+    removed, columns in valid_col_units are mapped through kmap (foreign key -> primary key), and
+    with DISABLE_DISTINCT the distinct flags are dropped.
+    The walk uses an explicit stack, so deeply nested subqueries do not hit the recursion limit.
+    Subqueries in conditions only get their values removed, while intersect/union/except get both
+    with the valid column units of the outer sql.
+    """
     if sql is None:
         return sql
-
-    sql['select'] = rebuild_select_col(valid_col_units, sql['select'], kmap)
-    sql['from'] = rebuild_from_col(valid_col_units, sql['from'], kmap)
-    sql['where'] = rebuild_condition_col(valid_col_units, sql['where'], kmap)
-    sql['groupBy'] = rebuild_group_by_col(valid_col_units, sql['groupBy'], kmap)
-    sql['orderBy'] = rebuild_order_by_col(valid_col_units, sql['orderBy'], kmap)
-    sql['having'] = rebuild_condition_col(valid_col_units, sql['having'], kmap)
-    sql['intersect'] = rebuild_sql_col(valid_col_units, sql['intersect'], kmap)
-    sql['except'] = rebuild_sql_col(valid_col_units, sql['except'], kmap)
-    sql['union'] = rebuild_sql_col(valid_col_units, sql['union'], kmap)
+    valid_col_units = set(valid_col_units)
+
+    def col_unit_col(col_unit):
+        if col_unit is None:
+            return col_unit
+        agg_id, col_id, distinct = col_unit
+        if col_id in kmap and col_id in valid_col_units:
+            col_id = kmap[col_id]
+        if DISABLE_DISTINCT:
+            distinct = None
+        return agg_id, col_id, distinct
+
+    def val_unit_col(val_unit):
+        if val_unit is None:
+            return val_unit
+        unit_op, col_unit1, col_unit2 = val_unit
+        return unit_op, col_unit_col(col_unit1), col_unit_col(col_unit2)
+
+    # (sql, whether to rebuild columns as well as values)
+    stack = [(sql, True)]
+    while stack:
+        node, with_col = stack.pop()
+        for conds_owner, key in ((node['from'], 'conds'), (node, 'where'), (node, 'having')):
+            condition = conds_owner[key]
+            if condition is None or not (with_col or DISABLE_VALUE):
+                continue
+            new_condition = []
+            for idx, cond_unit in enumerate(condition):
+                if idx % 2 == 1 or cond_unit is None:
+                    new_condition.append(cond_unit)
+                    continue
+                not_op, op_id, val_unit, val1, val2 = cond_unit
+                if DISABLE_VALUE:
+                    if type(val1) is dict:
+                        stack.append((val1, False))
+                    else:
+                        val1 = None
+                    if type(val2) is dict:
+                        stack.append((val2, False))
+                    else:
+                        val2 = None
+                if with_col:
+                    val_unit = val_unit_col(val_unit)
+                new_condition.append((not_op, op_id, val_unit, val1, val2))
+            conds_owner[key] = new_condition
+
+        for key in ('intersect', 'except', 'union'):
+            if node[key] is not None and (with_col or DISABLE_VALUE):
+                stack.append((node[key], with_col))
+
+        if not with_col:
+            continue
+        distinct, _list = node['select']
+        node['select'] = (None if DISABLE_DISTINCT else distinct,
+                          [(agg_id, val_unit_col(val_unit)) for agg_id, val_unit in _list])
+        node['from']['table_units'] = [
+            (table_type, col_unit_col(col_unit_or_sql) if isinstance(col_unit_or_sql, tuple) else col_unit_or_sql)
+            for table_type, col_unit_or_sql in node['from']['table_units']]
+        node['groupBy'] = [col_unit_col(col_unit) for col_unit in node['groupBy']]
+        if node['orderBy'] is not None and len(node['orderBy']) > 0:
+            direction, val_units = node['orderBy']
+            node['orderBy'] = (direction, [val_unit_col(val_unit) for val_unit in val_units])
 
     return sql
 
@@ -1084,8 +1382,67 @@ if __name__ == "__main__":
     parser.add_argument('--db', dest='db', type=str)
     parser.add_argument('--table', dest='table', type=str)
     parser.add_argument('--etype', dest='etype', type=str)
+    parser.add_argument('--schema_cache', dest='schema_cache', type=str, default=None,
+                        help='json file to persist db schemas across runs')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='number of evaluation processes, examples are sharded by db_id')
+    parser.add_argument('--exec_mode', dest='exec_mode', type=str, default='readonly', choices=['readonly', 'copy'],
+                        help='readonly: execute on the original db opened read-only; copy: execute on a per-db copy')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=60,
+                        help='per-query execution timeout in seconds, <= 0 disables it')
+    parser.add_argument('--flush_every', dest='flush_every', type=int, default=100,
+                        help='number of merged records buffered before writing merged_info.jsonl')
+    parser.add_argument('--fsync', dest='fsync', action='store_true',
+                        help='fsync merged_info.jsonl whenever it is checkpointed')
+    parser.add_argument('--schema_ref', dest='schema_ref', action='store_true',
+                        help='write each db schema once to schemas.jsonl and reference it by db_id in merged_info.jsonl')
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        help='ignore an existing checkpoint and evaluate from the first example')
+    parser.add_argument('--exec_cache', dest='exec_cache', type=str, default=None,
+                        help='sqlite file caching gold and predicted execution results across runs')
+    parser.add_argument('--parse_cache', dest='parse_cache', type=str, default=None,
+                        help='sqlite file caching parsed gold and predicted sql across runs')
+    parser.add_argument('--hardness_index', dest='hardness_index', type=str, default=None,
+                        help='hardness index of the gold set built by hardness_index.py')
+    parser.add_argument('--hardness_levels', dest='hardness_levels', type=str, default=None,
+                        help='only evaluate examples of these comma separated levels, e.g. "extra" or "hard,extra"')
+    parser.add_argument('--db_scores', dest='db_scores', type=str, default=None,
+                        help='json file to write execution/exact accuracy per db')
+    parser.add_argument('--bootstrap', dest='bootstrap', type=int, default=0,
+                        help='number of bootstrap resamples for confidence intervals per hardness level, 0 disables it')
+    parser.add_argument('--confidence', dest='confidence', type=float, default=0.95,
+                        help='confidence level of the bootstrap intervals')
+    parser.add_argument('--compare', dest='compare', type=str, nargs=2, default=None, metavar=('MERGED_A', 'MERGED_B'),
+                        help='compare exec acc of two merged_info.jsonl runs with paired bootstrap and McNemar tests '
+                             'instead of evaluating')
+    parser.add_argument('--exec_cmp', dest='exec_cmp', type=str, default='str', choices=['str', 'typed'],
+                        help='str: compare execution results by str(value); typed: compare numbers by value '
+                             '(1 == 1.0), decode bytes and keep None distinct from "None"')
+    parser.add_argument('--float_digits', dest='float_digits', type=int, default=None,
+                        help='with --exec_cmp typed, round floats to this many decimal places before comparing')
+    parser.add_argument('--exec_stream', dest='exec_stream', action='store_true',
+                        help='compare execution results while streaming both cursors and stop reading once the row '
+                             'counts differ (readonly mode)')
+    parser.add_argument('--result_sample', dest='result_sample', type=int, default=None,
+                        help='number of rows of each execution result kept in merged_info.jsonl, the full result is '
+                             'identified by its fingerprint (default: all rows, or 20 with --exec_stream)')
+    parser.add_argument('--ignore_order', dest='ignore_order', action='store_true',
+                        help='compare execution results as multisets even when the gold sql has ORDER BY')
+    parser.add_argument('--exec_backend', dest='exec_backend', type=str, default='python', choices=['python', 'columnar'],
+                        help='python: compare execution results row by row; columnar: compare them as numpy column '
+                             'arrays, falling back to python for mixed-type results (not used with --exec_stream)')
+    parser.add_argument('--float_atol', dest='float_atol', type=float, default=0.0,
+                        help='with --exec_backend columnar, absolute tolerance for float columns')
+    parser.add_argument('--float_rtol', dest='float_rtol', type=float, default=0.0,
+                        help='with --exec_backend columnar, relative tolerance for float columns')
+    parser.add_argument('--nltk_download', dest='nltk_download', action='store_true',
+                        help='download the nltk punkt_tab tokenizer data (not needed for evaluation)')
     args = parser.parse_args()
 
+    if args.nltk_download:
+        import nltk
+        nltk.download('punkt_tab')
+
     model = args.model
     exp_id = args.exp_id
     gold = args.gold
@@ -1094,9 +1451,40 @@ if __name__ == "__main__":
     db_dir = args.db
     table = args.table
     etype = args.etype
+    schema_cache = args.schema_cache
+    workers = args.workers
+    exec_mode = args.exec_mode
+    exec_timeout = args.timeout if args.timeout > 0 else None
+    flush_every = args.flush_every
+    fsync = args.fsync
+    schema_ref = args.schema_ref
+    restart = args.restart
+    exec_cache_file = args.exec_cache
+    parse_cache_file = args.parse_cache
+    hardness_index_file = args.hardness_index
+    hardness_levels = args.hardness_levels.split(',') if args.hardness_levels else None
+    db_scores_file = args.db_scores
+
+    bootstrap = args.bootstrap
+    confidence = args.confidence
+    row_normalizer = RowNormalizer(args.exec_cmp, args.float_digits)
+    exec_stream = args.exec_stream
+    result_sample = args.result_sample
+    ignore_order = args.ignore_order
+    comparator = None
+    if args.exec_backend == 'columnar':
+        comparator = ColumnarComparator(row_normalizer, args.float_atol, args.float_rtol)
+
+    if args.compare is not None:
+        compare_runs(args.compare[0], args.compare[1], acc, bootstrap or 10000, confidence, hardness_index_file,
+                     db_dir, schema_cache, parse_cache_file)
+        sys.exit(0)
 
     # assert etype in ["all", "exec", "match"], "Unknown evaluation method"
 
     kmaps = build_foreign_key_map_from_json(table)
 
-    evaluate(model, exp_id, gold, pred, acc, db_dir, etype, kmaps)
+    evaluate(model, exp_id, gold, pred, acc, db_dir, etype, kmaps, schema_cache, workers, exec_mode,
+             exec_timeout, flush_every, fsync, schema_ref, restart, exec_cache_file, parse_cache_file,
+             hardness_index_file, hardness_levels, db_scores_file, bootstrap, confidence, row_normalizer,
+             exec_stream, result_sample, ignore_order, comparator)
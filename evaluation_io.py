@@ -0,0 +1,186 @@
+import os
+import json
+import hashlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def iter_lines(file):
+    """逐行读取文件，跳过空行，返回去掉首尾空白的行"""
+    with open(file, "r", encoding="utf-8") as r:
+        for line in r:
+            line = line.strip()
+            if len(line) > 0:
+                yield line
+
+
+def iter_jsonl(file):
+    for line in iter_lines(file):
+        yield json.loads(line)
+
+
+def iter_eval_examples(gold, predict, detailed_gold_info_file, detailed_llm_info_file):
+    """
+    惰性地按行对齐gold文件、predict文件、detailed_gold_info.jsonl和predict.jsonl，每次只读取一条样例，
+    内存占用与数据集大小无关。
+    :param gold: gold文件，每行为 gold sql \\t db_id
+    :param predict: predict文件，每行为 predict sql
+    :return: 生成器，每个元素为dict：idx, predict, gold, db_id, info(gold详细信息), info_llm(llm输出的详细信息)
+    """
+    golds = iter_lines(gold)
+    predicts = iter_lines(predict)
+    infos = iter_jsonl(detailed_gold_info_file)
+    infos_llm = iter_jsonl(detailed_llm_info_file)
+
+    # 与原先zip(plist, glist)一致，gold和predict中较短的一个结束时评估结束
+    for idx, (p, g) in enumerate(zip(predicts, golds)):
+        g_str, db_name = g.split('\t')
+        info = next(infos, None)
+        if info is None:
+            raise ValueError("{} has fewer examples than {} (example {})".format(detailed_gold_info_file, gold, idx))
+        info_llm = next(infos_llm, None)
+        if info_llm is None:
+            raise ValueError("{} has fewer examples than {} (example {})".format(detailed_llm_info_file, predict, idx))
+
+        # 校验各个文件中的样例是否对齐
+        if info["db_id"] != db_name:
+            raise ValueError("example {}: db_id {} in {} does not match {} in {}".format(
+                idx, info["db_id"], detailed_gold_info_file, db_name, gold))
+        if "id" in info and "id" in info_llm and info["id"] != info_llm["id"]:
+            raise ValueError("example {}: id {} in {} does not match id {} in {}".format(
+                idx, info["id"], detailed_gold_info_file, info_llm["id"], detailed_llm_info_file))
+
+        yield {
+            "idx": idx,
+            "predict": p.split('\t')[0],
+            "gold": g_str,
+            "db_id": db_name,
+            "info": info,
+            "info_llm": info_llm
+        }
+
+
+class SchemaSideFile:
+    """
+    schemas.jsonl：每个db的table schema只写一次，merged_info.jsonl中的记录通过db_id引用，
+    避免每条记录都重复存储完整的schema。
+    """
+    def __init__(self, file):
+        self.file = file
+        self._written = set()
+        if os.path.exists(file):
+            for record in iter_jsonl(file):
+                self._written.add(record["db_id"])
+
+    def add(self, db_id, tables):
+        if db_id in self._written:
+            return
+        with open(self.file, "a", encoding="utf-8") as w:
+            w.write(json.dumps({"db_id": db_id, "tables": tables}) + "\n")
+        self._written.add(db_id)
+
+
+def load_schemas_file(file):
+    """读取schemas.jsonl，返回 db_id -> tables"""
+    return {record["db_id"]: record["tables"] for record in iter_jsonl(file)}
+
+
+def resolve_tables(merged_record, schemas):
+    """为以db_id引用schema的merged记录补全tables字段"""
+    if "tables" not in merged_record:
+        merged_record["tables"] = schemas.get(merged_record["db_id"])
+    return merged_record
+
+
+class MergedInfoWriter:
+    """
+    merged_info.jsonl的写入器：整个评估过程只打开一次文件，按batch_size条缓冲后批量写入。
+    checkpoint()将缓冲区写入文件，fsync=True时同时落盘。安装了orjson时使用orjson序列化。
+    truncate_to: 打开时将文件截断到该字节数（从checkpoint恢复时丢弃checkpoint之后写入的记录）
+    """
+    def __init__(self, file, batch_size=100, fsync=False, use_orjson=True, truncate_to=None):
+        self.file = file
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.use_orjson = use_orjson and orjson is not None
+        self._buffer = []
+        self._handle = open(file, "ab")
+        if truncate_to is not None:
+            self._handle.truncate(truncate_to)
+
+    def dumps(self, record):
+        if self.use_orjson:
+            try:
+                return orjson.dumps(record)
+            except TypeError:  # orjson不支持的类型（如超过64位的整数）退回json
+                pass
+        return json.dumps(record).encode("utf-8")
+
+    def write(self, record):
+        self._buffer.append(self.dumps(record))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._handle.write(b"\n".join(self._buffer) + b"\n")
+            self._buffer = []
+        self._handle.flush()
+
+    def checkpoint(self):
+        """将缓冲区写入文件，返回当前文件的字节数"""
+        self.flush()
+        if self.fsync:
+            os.fsync(self._handle.fileno())
+        return self._handle.tell()
+
+    def close(self):
+        if self._handle.closed:
+            return
+        self.checkpoint()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_checkpoint(file):
+    if not os.path.exists(file):
+        return None
+    with open(file, "r", encoding="utf-8") as r:
+        return json.load(r)
+
+
+def save_checkpoint(file, state):
+    """先写临时文件再替换，保证checkpoint文件总是完整的"""
+    tmp_file = file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as w:
+        json.dump(state, w)
+    os.replace(tmp_file, file)
+
+
+# hardness索引中每条记录的字段，由hardness_index.py生成
+HARDNESS_INDEX_FIELDS = ["hardness", "component1", "component2", "others", "keywords"]
+
+
+def hardness_key(db_id, query):
+    """hardness索引的key：db_id和gold sql文本的sha1"""
+    return hashlib.sha1((db_id + "\0" + query.strip()).encode("utf-8")).hexdigest()
+
+
+def load_hardness_index(file):
+    """
+    读取hardness_index.py生成的索引文件
+    :return: dict，hardness_key(db_id, query) -> [hardness, component1, component2, others, keywords]
+    """
+    with open(file, "r", encoding="utf-8") as r:
+        index = json.load(r)
+    if index.get("fields") != HARDNESS_INDEX_FIELDS:
+        raise ValueError("{} is not a hardness index (fields {})".format(file, index.get("fields")))
+    return index["entries"]
@@ -0,0 +1,140 @@
+import os
+import numpy as np
+
+# 每条样例在数组中占一行，列依次为：困难等级下标、db下标、exec得分、exact得分，
+# 之后每个partial类型占PARTIAL_FIELDS对应的5列
+LEVEL, DB, EXEC, EXACT = range(4)
+PARTIAL_FIELDS = ['acc', 'rec', 'f1', 'acc_count', 'rec_count']
+
+
+class ScoresAccumulator:
+    """
+    按列存储的得分累加器：每条样例的exec/exact/partial得分记录为numpy数组中的一行，
+    最终的各困难等级得分、按db的得分等在评估结束时通过数组运算得到。
+    多进程评估时worker的结果按原始顺序返回主进程后逐条add（主进程还需要逐条写入merged_info.jsonl和checkpoint）。
+    levels: 困难等级，最后一个为'all'（包含所有样例）
+    """
+    def __init__(self, levels, partial_types, etype, capacity=1024):
+        self.levels = levels
+        self.partial_types = partial_types
+        self.etype = etype
+        self.width = 4 + len(partial_types) * len(PARTIAL_FIELDS)
+        self.data = np.zeros((capacity, self.width))
+        self.n = 0
+        self.db_ids = []
+        self._db_index = {}
+        self._saved = 0  # 已经写入checkpoint文件的行数
+
+    @property
+    def rows(self):
+        return self.data[:self.n]
+
+    def db_index(self, db_id):
+        if db_id not in self._db_index:
+            self._db_index[db_id] = len(self.db_ids)
+            self.db_ids.append(db_id)
+        return self._db_index[db_id]
+
+    def _reserve(self, n):
+        if self.n + n > len(self.data):
+            data = np.zeros((max(2 * len(self.data), self.n + n), self.width))
+            data[:self.n] = self.rows
+            self.data = data
+
+    def add(self, result, db_id):
+        """记录一条样例的评估结果（eval_single的返回值）"""
+        row = [self.levels.index(result["hardness"]), self.db_index(db_id), 0., 0.]
+        if self.etype in ["all", "exec"] and result["exec_score"]:
+            row[EXEC] = 1.
+        if self.etype in ["all", "match"]:
+            row[EXACT] = result["exact_score"]
+            for type_ in self.partial_types:
+                partial_score = result["partial_scores"][type_]
+                acc_count = 1 if partial_score['pred_total'] > 0 else 0
+                rec_count = 1 if partial_score['label_total'] > 0 else 0
+                row += [partial_score['acc'] * acc_count, partial_score['rec'] * rec_count, partial_score['f1'],
+                        acc_count, rec_count]
+        else:
+            row += [0.] * (self.width - 4)
+        self._reserve(1)
+        self.data[self.n] = row
+        self.n += 1
+
+    def level_sums(self, rows=None):
+        """
+        :return: (counts, sums)，counts[level]为样例数，sums[level]为各列之和，最后一个level为'all'
+        """
+        rows = self.rows if rows is None else rows
+        level_idx = rows[:, LEVEL].astype(np.int64)
+        counts = np.bincount(level_idx, minlength=len(self.levels))
+        sums = np.zeros((len(self.levels), self.width))
+        np.add.at(sums, level_idx, rows)
+        counts[-1] = len(rows)
+        sums[-1] = rows.sum(axis=0)
+        return counts, sums
+
+    def scores(self, rows=None):
+        """
+        汇总得分，返回与原先evaluate中scores字典相同的格式，可直接用于print_scores
+        """
+        counts, sums = self.level_sums(rows)
+        scores = {}
+        for level_idx, level in enumerate(self.levels):
+            count = int(counts[level_idx])
+            level_sums = sums[level_idx]
+            partial_sums = level_sums[4:].reshape(len(self.partial_types), len(PARTIAL_FIELDS))
+            scores[level] = {'count': count, 'partial': {}, 'exact': float(level_sums[EXACT]),
+                             'exec': float(level_sums[EXEC])}
+            for type_, (acc, rec, f1, acc_count, rec_count) in zip(self.partial_types, partial_sums):
+                scores[level]['partial'][type_] = {'acc': float(acc), 'rec': float(rec), 'f1': float(f1),
+                                                   'acc_count': int(acc_count), 'rec_count': int(rec_count)}
+            if count == 0:
+                continue
+            if self.etype in ["all", "exec"]:
+                scores[level]['exec'] /= count
+            if self.etype in ["all", "match"]:
+                scores[level]['exact'] /= count
+                for type_ in self.partial_types:
+                    partial = scores[level]['partial'][type_]
+                    partial['acc'] = partial['acc'] / partial['acc_count'] if partial['acc_count'] > 0 else 0
+                    partial['rec'] = partial['rec'] / partial['rec_count'] if partial['rec_count'] > 0 else 0
+                    if partial['acc'] == 0 and partial['rec'] == 0:
+                        partial['f1'] = 1
+                    else:
+                        partial['f1'] = 2.0 * partial['acc'] * partial['rec'] / (partial['rec'] + partial['acc'])
+        return scores
+
+    def db_scores(self):
+        """按db汇总：db_id -> {"count", "exec", "exact"}"""
+        rows = self.rows
+        db_idx = rows[:, DB].astype(np.int64)
+        counts = np.bincount(db_idx, minlength=len(self.db_ids))
+        exec_sums = np.bincount(db_idx, weights=rows[:, EXEC], minlength=len(self.db_ids))
+        exact_sums = np.bincount(db_idx, weights=rows[:, EXACT], minlength=len(self.db_ids))
+        return {db_id: {"count": int(counts[i]), "exec": float(exec_sums[i] / counts[i]),
+                        "exact": float(exact_sums[i] / counts[i])}
+                for i, db_id in enumerate(self.db_ids) if counts[i] > 0}
+
+    def checkpoint(self, file):
+        """将上次checkpoint之后的样例追加写入file，返回file中的样例数"""
+        with open(file, "ab") as w:
+            w.write(self.data[self._saved:self.n].tobytes())
+        self._saved = self.n
+        return self.n
+
+    def restore(self, file, n, db_ids):
+        """从checkpoint恢复：读取file中的前n条样例，并截掉其后写入的部分"""
+        with open(file, "r+b") as f:
+            f.truncate(n * self.width * self.data.itemsize)
+        rows = np.fromfile(file, dtype=self.data.dtype).reshape(-1, self.width)
+        self.n = 0
+        self._reserve(len(rows))
+        self.data[:len(rows)] = rows
+        self.n = self._saved = len(rows)
+        self.db_ids = list(db_ids)
+        self._db_index = {db_id: i for i, db_id in enumerate(self.db_ids)}
+
+    @staticmethod
+    def remove_checkpoint(file):
+        if os.path.exists(file):
+            os.remove(file)
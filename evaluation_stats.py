@@ -0,0 +1,104 @@
+import math
+import numpy as np
+
+# 重采样矩阵的最大元素数，超过时分批生成
+MAX_RESAMPLE_CELLS = 1 << 22
+# 不同取值的数量不超过该值时按多项分布重采样，否则按下标重采样
+MAX_MULTINOMIAL_VALUES = 64
+
+
+def bootstrap_means(values, n_resamples=10000, seed=0):
+    """
+    对values（n条样例，每条可以有多列得分）做bootstrap重采样，返回每次重采样的均值
+    exec/exact得分只有少数几种取值：有放回地抽取n条样例，各取值被抽中的次数服从多项分布，
+    因此直接对取值的计数做多项分布采样，与逐条抽取下标等价，开销与样例数无关
+    :param values: shape为(n,)或(n, k)
+    :return: shape为(n_resamples, k)的数组
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values.reshape(len(values), -1)
+    n = len(values)
+    means = np.full((n_resamples, values.shape[1]), np.nan)
+    if n == 0:
+        return means
+    rng = np.random.default_rng(seed)
+    uniq, counts = np.unique(values, axis=0, return_counts=True)
+    if len(uniq) <= MAX_MULTINOMIAL_VALUES:
+        chunk = max(1, MAX_RESAMPLE_CELLS // len(uniq))
+        for start in range(0, n_resamples, chunk):
+            stop = min(start + chunk, n_resamples)
+            weights = rng.multinomial(n, counts / n, size=stop - start)
+            means[start:stop] = weights @ uniq / n
+    else:
+        chunk = max(1, MAX_RESAMPLE_CELLS // n)
+        for start in range(0, n_resamples, chunk):
+            stop = min(start + chunk, n_resamples)
+            idx = rng.integers(0, n, size=(stop - start, n))
+            means[start:stop] = values[idx].mean(axis=1)
+    return means
+
+
+def percentile_interval(samples, alpha=0.05):
+    """
+    :return: (low, high)，samples各列的百分位置信区间
+    """
+    low, high = np.percentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return low, high
+
+
+def level_confidence_intervals(level_idx, values, levels, n_resamples=10000, alpha=0.05, seed=0):
+    """
+    按困难等级计算各列得分的bootstrap置信区间，每个等级在其自身的样例上重采样，'all'（最后一个等级）在全部样例上重采样
+    :param level_idx: 每条样例的困难等级下标
+    :param values: shape为(n, k)，每条样例的k列得分
+    :return: dict，level -> [(mean, low, high), ...]，每列一个，没有样例的等级为None
+    """
+    level_idx = np.asarray(level_idx, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64).reshape(len(level_idx), -1)
+    intervals = {}
+    for i, level in enumerate(levels):
+        level_values = values if i == len(levels) - 1 else values[level_idx == i]
+        if len(level_values) == 0:
+            intervals[level] = None
+            continue
+        low, high = percentile_interval(bootstrap_means(level_values, n_resamples, seed + i), alpha)
+        intervals[level] = [(float(mean), float(l), float(h))
+                            for mean, l, h in zip(level_values.mean(axis=0), low, high)]
+    return intervals
+
+
+def paired_bootstrap(a, b, n_resamples=10000, alpha=0.05, seed=0):
+    """
+    配对bootstrap检验：对两次运行在同一批样例上的得分a、b同时重采样
+    p值为重采样的差值相对观测差值的偏移不小于观测差值的比例（以观测差值为中心近似零假设下的分布）
+    :return: dict，diff为mean(a) - mean(b)，low/high为差值的置信区间
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if len(a) == 0:
+        return {"n": 0, "diff": float("nan"), "low": float("nan"), "high": float("nan"), "p_value": float("nan")}
+    means = bootstrap_means(np.stack([a, b], axis=1), n_resamples, seed)
+    diffs = means[:, 0] - means[:, 1]
+    diff = float(a.mean() - b.mean())
+    low, high = percentile_interval(diffs, alpha)
+    p_value = float(np.mean(np.abs(diffs - diff) >= abs(diff) - 1e-12))
+    return {"n": len(a), "diff": diff, "low": float(low), "high": float(high), "p_value": p_value}
+
+
+def mcnemar(a, b):
+    """
+    McNemar检验：只看两次运行结果不一致的样例，a对b错的数量为n10，a错b对的数量为n01
+    p值为精确的双侧二项检验，statistic为带连续性修正的卡方统计量
+    """
+    a = np.asarray(a).astype(bool)
+    b = np.asarray(b).astype(bool)
+    n10 = int(np.count_nonzero(a & ~b))
+    n01 = int(np.count_nonzero(~a & b))
+    n = n10 + n01
+    if n == 0:
+        return {"n10": 0, "n01": 0, "statistic": 0.0, "p_value": 1.0}
+    statistic = (abs(n10 - n01) - 1) ** 2 / n
+    # 整数运算避免n较大时0.5 ** n下溢
+    tail = sum(math.comb(n, k) for k in range(min(n10, n01) + 1))
+    p_value = min(1.0, 2 * tail / 2 ** n)
+    return {"n10": n10, "n01": n01, "statistic": float(statistic), "p_value": p_value}
@@ -0,0 +1,120 @@
+import os
+import re
+import pickle
+import sqlite3
+import hashlib
+
+# 引号内的字符串/标识符保持原样，其余部分做规范化
+_SQL_SEGMENT_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|[^'\"`]+|['\"`]")
+_SPACE_RE = re.compile(r"\s+")
+_PUNCT_SPACE_RE = re.compile(r"\s*([(),])\s*")
+
+
+def normalize_sql(sql_str):
+    """
+    规范化sql文本用于缓存的key：引号外的部分折叠空白、去掉括号和逗号两侧的空白并转为小写，
+    去掉末尾的分号；引号内的字符串值和标识符保持不变。
+    """
+    segments = []
+    for segment in _SQL_SEGMENT_RE.findall(sql_str.strip().rstrip(';').strip()):
+        if segment[0] in "'\"`" and len(segment) > 1:
+            segments.append(segment)
+        else:
+            segment = _SPACE_RE.sub(" ", segment.lower())
+            segments.append(_PUNCT_SPACE_RE.sub(r"\1", segment))
+    return "".join(segments)
+
+
+class ExecResultCache:
+    """
+    sql执行结果的持久化缓存（sqlite文件）。key由db文件内容的指纹和规范化后的sql组成，
+    因此只要db文件内容不变，不同模型/实验之间相同sql的执行结果可以直接复用。
+    缓存的值为 (result, exec_time, error_message)，result中的每行转换为tuple后存储。
+    新的执行结果先保存在内存中，每commit_every条或flush/close时在一个短事务中批量写入，
+    执行sql期间不持有缓存文件的写锁，多个worker或多次运行可以共享同一个缓存文件。
+    """
+    def __init__(self, cache_file, max_rows=100000, commit_every=1000):
+        self.cache_file = cache_file
+        self.max_rows = max_rows  # 结果行数超过max_rows的不缓存
+        self.commit_every = commit_every
+        self._conn = None
+        self._pid = None
+        self._pending = {}  # key -> 待写入的行
+        self._pending_pid = None
+        self._fingerprints = {}  # (db path, mtime, size) -> db文件内容的sha1
+
+    def _connect(self):
+        # 连接不能跨进程共享，fork出的worker进程中重新打开
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.cache_file, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS exec_results ("
+                               "key TEXT PRIMARY KEY, result BLOB, exec_time REAL, error_message TEXT)")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def db_fingerprint(self, db):
+        stat = os.stat(db)
+        key = (os.path.abspath(db), stat.st_mtime, stat.st_size)
+        if key not in self._fingerprints:
+            sha1 = hashlib.sha1()
+            with open(db, "rb") as r:
+                for block in iter(lambda: r.read(1 << 20), b""):
+                    sha1.update(block)
+            self._fingerprints[key] = sha1.hexdigest()
+        return self._fingerprints[key]
+
+    def make_key(self, db, sql_str):
+        return hashlib.sha1((self.db_fingerprint(db) + "\0" + normalize_sql(sql_str)).encode("utf-8")).hexdigest()
+
+    def _own_pending(self):
+        """待写入的行只属于写入它们的进程，fork出的worker中丢弃从父进程继承的部分"""
+        if self._pending_pid != os.getpid():
+            self._pending = {}
+            self._pending_pid = os.getpid()
+        return self._pending
+
+    def get(self, db, sql_str):
+        key = self.make_key(db, sql_str)
+        row = self._own_pending().get(key)
+        if row is None:
+            row = self._connect().execute("SELECT result, exec_time, error_message FROM exec_results WHERE key = ?",
+                                          (key,)).fetchone()
+        else:
+            row = row[1:]
+        if row is None:
+            return None
+        result = pickle.loads(row[0]) if row[0] is not None else None
+        return result, row[1], row[2]
+
+    def put(self, db, sql_str, result, exec_time, error_message):
+        if result is not None:
+            if len(result) > self.max_rows:
+                return
+            result = pickle.dumps([tuple(row) for row in result], protocol=pickle.HIGHEST_PROTOCOL)
+        pending = self._own_pending()
+        key = self.make_key(db, sql_str)
+        pending[key] = (key, result, exec_time, error_message)
+        if len(pending) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        pending = self._own_pending()
+        if not pending:
+            return
+        rows = list(pending.values())
+        pending.clear()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO exec_results VALUES (?, ?, ?, ?)", rows)
+        except sqlite3.OperationalError as e:
+            # 缓存文件被其他进程长时间锁住等：放弃这批写入，只影响缓存，不中断评估
+            print("exec cache: skip writing {} results to {}: {}".format(len(rows), self.cache_file, e))
+
+    def close(self):
+        self.flush()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
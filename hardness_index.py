@@ -0,0 +1,72 @@
+import os
+import json
+import argparse
+from evaluation import Evaluator, count_component1, count_component2, count_others, get_keywords
+from evaluation_io import iter_lines, hardness_key, HARDNESS_INDEX_FIELDS
+from process_sql import SchemaRegistry, ParseCache
+
+
+def iter_gold_queries(gold):
+    """
+    读取gold集合中的(db_id, query)
+    :param gold: spider格式的json文件（如spider_data/test.json，每条包含db_id和query），
+                 或evaluate使用的gold文件（每行为 gold sql \t db_id）
+    """
+    if gold.endswith(".json"):
+        with open(gold, "r", encoding="utf-8") as r:
+            for example in json.load(r):
+                yield example["db_id"], example["query"]
+    else:
+        for line in iter_lines(gold):
+            query, db_id = line.split('\t')
+            yield db_id, query
+
+
+def build_hardness_index(gold, db_dir, schema_cache=None, parse_cache_file=None):
+    """
+    为gold集合中的每条sql预先计算困难等级、各部分的计数和关键字
+    parse_cache_file: 与evaluation.py的--parse_cache相同的解析缓存文件，建索引时的解析结果在评估时直接复用
+    :return: dict，hardness_key(db_id, query) -> [hardness, component1, component2, others, keywords]
+    """
+    evaluator = Evaluator()
+    schema_registry = SchemaRegistry(schema_cache)
+    parse_cache = ParseCache(cache_file=parse_cache_file)
+    entries = {}
+    for db_id, query in iter_gold_queries(gold):
+        key = hardness_key(db_id, query)
+        if key in entries:
+            continue
+        schema = schema_registry.get(os.path.join(db_dir, db_id, db_id + ".sqlite"))
+        sql = parse_cache.get_sql(schema, query)
+        entries[key] = [evaluator.eval_hardness(sql), count_component1(sql), count_component2(sql),
+                        count_others(sql), sorted(get_keywords(sql))]
+    parse_cache.close()
+    schema_registry.save()
+    return entries
+
+
+def save_hardness_index(file, entries):
+    tmp_file = file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as w:
+        json.dump({"fields": HARDNESS_INDEX_FIELDS, "entries": entries}, w, separators=(",", ":"))
+    os.replace(tmp_file, file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gold', dest='gold', type=str,
+                        help='gold set: spider json file (db_id/query) or gold file with "sql\\tdb_id" lines')
+    parser.add_argument('--db', dest='db', type=str)
+    parser.add_argument('--out', dest='out', type=str, help='index file to write')
+    parser.add_argument('--schema_cache', dest='schema_cache', type=str, default=None,
+                        help='json file caching db schemas across runs')
+    parser.add_argument('--parse_cache', dest='parse_cache', type=str, default=None,
+                        help='sqlite file caching parsed sql, shared with evaluation.py --parse_cache')
+    args = parser.parse_args()
+
+    entries = build_hardness_index(args.gold, args.db, args.schema_cache, args.parse_cache)
+    save_hardness_index(args.out, entries)
+    counts = {}
+    for entry in entries.values():
+        counts[entry[0]] = counts.get(entry[0], 0) + 1
+    print("{} queries indexed to {}: {}".format(len(entries), args.out, counts))
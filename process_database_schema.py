@@ -1,6 +1,6 @@
 import os
 import json
-from altair.vegalite.v5.display import json_renderer
+import functools
 
 current_file_path = os.path.abspath(__file__)
 current_dir = os.path.dirname(current_file_path)
@@ -34,7 +34,11 @@ def process_table_schema(db: dict):
     return table_schema_list
 
 
+@functools.lru_cache(maxsize=256)
 def load_database_table_schema(db_name):
+    """
+    读取db的schema.json，结果按db_name缓存。返回的对象被所有调用方共享，不要原地修改
+    """
     file_database_temp = os.path.join(current_dir, "spider_data", "database", db_name, "schema.json")
     file_test_database_temp = os.path.join(current_dir, "spider_data", "test_database", db_name, "schema.json")
     if os.path.exists(file_database_temp):
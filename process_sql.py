@@ -24,9 +24,13 @@
 # }
 ################################
 
+import os
+import re
 import json
+import pickle
 import sqlite3
-from nltk import word_tokenize
+import hashlib
+import collections
 
 CLAUSE_KEYWORDS = ('select', 'from', 'where', 'group', 'order', 'limit', 'intersect', 'union', 'except')
 JOIN_KEYWORDS = ('join', 'on', 'as')
@@ -52,6 +56,8 @@ class Schema:
     def __init__(self, schema):
         self._schema = schema
         self._idMap = self._map(self._schema)
+        self._tableCols = None
+        self._fingerprint = None
 
     @property
     def schema(self):
@@ -61,6 +67,23 @@ class Schema:
     def idMap(self):
         return self._idMap
 
+    @property
+    def tableCols(self):
+        """table prefix ("__table") -> column ids of that table, built once per schema"""
+        if self._tableCols is None:
+            self._tableCols = {}
+            for value in self._idMap.values():
+                if '.' in value:
+                    self._tableCols.setdefault(value[:value.index('.')], []).append(value)
+        return self._tableCols
+
+    @property
+    def fingerprint(self):
+        """sha1 of the schema dict, identifies the schema independently of the db path"""
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha1(json.dumps(self._schema).encode("utf-8")).hexdigest()
+        return self._fingerprint
+
     def _map(self, schema):
         idMap = {'*': "__all__"}
         id = 1
@@ -96,10 +119,52 @@ def get_schema(db):
     for table in tables:
         cursor.execute("PRAGMA table_info({})".format(table))
         schema[table] = [str(col[1].lower()) for col in cursor.fetchall()]
+    conn.close()
 
     return schema
 
 
+class SchemaRegistry:
+    """
+    Cache of Schema objects keyed by db path and file mtime, so that every db is
+    introspected only once per run. With cache_file set, the raw schema dicts are
+    persisted to disk and later runs skip sqlite introspection entirely.
+    """
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._schemas = {}  # (db path, mtime) -> Schema
+        self._raw = {}  # db path -> {"mtime": mtime, "schema": schema dict}
+        self._dirty = False
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as r:
+                self._raw = json.load(r)
+
+    def get(self, db):
+        path = os.path.abspath(db)
+        mtime = os.path.getmtime(path)
+        key = (path, mtime)
+        if key in self._schemas:
+            return self._schemas[key]
+
+        entry = self._raw.get(path)
+        if entry is None or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "schema": get_schema(path)}
+            self._raw[path] = entry
+            self._dirty = True
+        schema = Schema(entry["schema"])
+        self._schemas[key] = schema
+        return schema
+
+    def save(self):
+        if self.cache_file is None or not self._dirty:
+            return
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as w:
+            json.dump(self._raw, w)
+        os.replace(tmp_file, self.cache_file)
+        self._dirty = False
+
+
 def get_schema_from_json(fpath):
     with open(fpath) as f:
         data = json.load(f)
@@ -113,36 +178,92 @@ def get_schema_from_json(fpath):
     return schema
 
 
+# SQL lexer reproducing the token stream of nltk's word_tokenize on sql strings (after string values
+# are taken out), in a single pass:
+#   val:   a string value ("..." after ' -> " replacement)
+#   sep:   characters always split into their own token, `` / ` / .. / -- runs and a period that only
+#          has closing brackets after it
+#   comma: , and : are split unless followed by a digit (see tokenize)
+#   word:  everything else, a token is a run of consecutive val/comma/word pieces
+TOKEN_RE = re.compile(r'''
+    (?P<ws>\s+)
+  | (?P<val>"[^"]*")
+  | (?P<sep>[;@#$%&?!*()\[\]{}<>\u00ab\u201c\u2018\u201e\u00bb\u201d\u2019\u2012-\u2015]|``?|\.{2,}|--
+        |\.(?=[\])}>\u00bb\u201d\u2019 ]*\s*$))
+  | (?P<comma>[:,])
+  | (?P<word>[^\s"`;@#$%&?!*()\[\]{}<>\u00ab\u201c\u2018\u201e\u00bb\u201d\u2019\u2012-\u2015:,.-]+|[.-])
+''', re.VERBOSE)
+DIGIT_RE = re.compile(r"\d")
+# nltk splits these words into two tokens (contractions without apostrophes). Kept only for bug-for-bug
+# compatibility with the nltk tokenizer (checked by tokenize_compat.py): an identifier such as `cannot`
+# would still be split in two, as it was before
+CONTRACTIONS_RE = re.compile(r"\b(?:(can)(not)|(gim)(me)|(gon)(na)|(got)(ta)|(lem)(me))\b|\b(wan)(na)$")
+EQ_PREFIX = ('!', '>', '<')
+
+
 def tokenize(string):
     string = str(string)
     string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
-    quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
-    assert len(quote_idxs) % 2 == 0, "Unexpected quote"
+    assert string.count('"') % 2 == 0, "Unexpected quote"
 
-    # keep string value as token
+    toks = []
     vals = {}
-    for i in range(len(quote_idxs)-1, -1, -2):
-        qidx1 = quote_idxs[i-1]
-        qidx2 = quote_idxs[i]
-        val = string[qidx1: qidx2+1]
-        key = "__val_{}_{}__".format(qidx1, qidx2)
-        string = string[:qidx1] + key + string[qidx2+1:]
-        vals[key] = val
-
-    toks = [word.lower() for word in word_tokenize(string)]
-    # replace with string value token
-    for i in range(len(toks)):
-        if toks[i] in vals:
-            toks[i] = vals[toks[i]]
-
-    # find if there exists !=, >=, <=
-    eq_idxs = [idx for idx, tok in enumerate(toks) if tok == "="]
-    eq_idxs.reverse()
-    prefix = ('!', '>', '<')
-    for eq_idx in eq_idxs:
-        pre_tok = toks[eq_idx-1]
-        if pre_tok in prefix:
-            toks = toks[:eq_idx-1] + [pre_tok + "="] + toks[eq_idx+1: ]
+    word = []  # pieces of the current token
+    n = len(string)
+    comma_consumed = False  # the previous , or : was split and swallowed the current character
+
+    def end_word():
+        if not word:
+            return
+        tok = "".join(word).lower()
+        word.clear()
+        if tok in vals:
+            # replace with string value token
+            toks.append(vals[tok])
+            return
+        parts = [tok]
+        if CONTRACTIONS_RE.search(tok):
+            parts = CONTRACTIONS_RE.sub(lambda m: " " + " ".join(g for g in m.groups() if g) + " ", tok).split()
+        for part in parts:
+            if part == "=" and toks and toks[-1] in EQ_PREFIX:
+                # merge !=, >=, <=
+                toks[-1] += "="
+            else:
+                toks.append(part)
+
+    for m in TOKEN_RE.finditer(string):
+        kind = m.lastgroup
+        if kind == "word":
+            word.append(m.group())
+        elif kind == "val":
+            # keep string value as token
+            key = "__val_{}_{}__".format(m.start(), m.end() - 1)
+            vals[key] = m.group()
+            word.append(key)
+        elif kind == "comma":
+            # nltk splits off a , or : followed by a non-digit (swallowing that character, so of two
+            # consecutive ones only the first is split) or at the end of the string
+            pos = m.start()
+            if pos + 1 == n or (not comma_consumed and not DIGIT_RE.match(string, pos + 1)):
+                end_word()
+                toks.append(m.group())
+                comma_consumed = pos + 1 < n and string[pos + 1] in ":,"
+                continue
+            if comma_consumed:
+                end_word()
+            word.append(m.group())
+        else:
+            end_word()
+            if kind == "sep":
+                toks.append(m.group())
+        comma_consumed = False
+    end_word()
+
+    if len(toks) > 1 and toks[0] == "=" and toks[-1] in EQ_PREFIX:
+        # bug-for-bug compatibility with the previous nltk based tokenize: its index based merge looked at
+        # toks[eq_idx - 1], which for a leading "=" wrapped around to the last token. No valid sql starts
+        # with "=", so nothing depends on this; it only keeps tokenize_compat.py exact
+        toks = toks[:-1] + [toks[-1] + "="] + toks[1:]
 
     return toks
 
@@ -555,6 +676,131 @@ def get_sql(schema, query):
     return sql
 
 
+class ParseCache:
+    """
+    Memoized get_sql keyed by schema fingerprint and normalized query. Parse failures are
+    cached too and re-raised on every hit. Entries are kept pickled in a bounded LRU,
+    so every hit returns a fresh sql dict that callers may modify. With cache_file set,
+    entries are also stored in a sqlite file and reused by later runs and other processes;
+    new entries are buffered and written in one short transaction every commit_every
+    entries or on flush/close, so no write lock is held while queries are parsed.
+    """
+    def __init__(self, maxsize=100000, cache_file=None, commit_every=1000):
+        self.maxsize = maxsize
+        self.cache_file = cache_file
+        self.commit_every = commit_every
+        self._entries = collections.OrderedDict()  # key -> (ok, pickled sql or exception)
+        self._conn = None
+        self._pid = None
+        self._pending = {}  # key -> row not yet written to cache_file
+        self._pending_pid = None
+
+    def _connect(self):
+        # sqlite connections can not be shared with forked worker processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.cache_file, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS parsed_sql (key TEXT PRIMARY KEY, ok INTEGER, value BLOB)")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _own_pending(self):
+        # rows buffered by the parent process are written by the parent, not by forked workers
+        if self._pending_pid != os.getpid():
+            self._pending = {}
+            self._pending_pid = os.getpid()
+        return self._pending
+
+    @staticmethod
+    def normalize_query(query):
+        """
+        The token sequence get_sql parses, without trailing semicolons, so queries that only
+        differ in case, spacing or a trailing ';' share an entry. Queries that can not be
+        tokenized are keyed by their text.
+        """
+        try:
+            toks = tokenize(query)
+        except AssertionError:
+            return str(query)
+        while toks and toks[-1] == ";":
+            toks.pop()
+        return json.dumps(toks)
+
+    @classmethod
+    def make_key(cls, schema, query):
+        return hashlib.sha1((schema.fingerprint + "\0" + cls.normalize_query(query)).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if self.cache_file is not None:
+            row = self._own_pending().get(key)
+            if row is not None:
+                row = row[1:]
+            else:
+                row = self._connect().execute("SELECT ok, value FROM parsed_sql WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = (bool(row[0]), row[1])
+                self._remember(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        self._remember(key, entry)
+        if self.cache_file is not None:
+            pending = self._own_pending()
+            pending[key] = (key, int(entry[0]), entry[1])
+            if len(pending) >= self.commit_every:
+                self.flush()
+
+    def get_sql(self, schema, query):
+        key = self.make_key(schema, query)
+        entry = self._lookup(key)
+        if entry is None:
+            try:
+                sql = get_sql(schema, query)
+            except Exception as e:
+                try:
+                    entry = (False, pickle.dumps(e, protocol=pickle.HIGHEST_PROTOCOL))
+                except Exception:  # exception that can not be pickled, do not cache it
+                    raise e
+                self._store(key, entry)
+                raise
+            entry = (True, pickle.dumps(sql, protocol=pickle.HIGHEST_PROTOCOL))
+            self._store(key, entry)
+            return sql
+        if not entry[0]:
+            raise pickle.loads(entry[1])
+        return pickle.loads(entry[1])
+
+    def flush(self):
+        pending = self._own_pending()
+        if not pending:
+            return
+        rows = list(pending.values())
+        pending.clear()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO parsed_sql VALUES (?, ?, ?)", rows)
+        except sqlite3.OperationalError as e:
+            # e.g. cache_file kept locked by another process: drop the batch, it is only a cache
+            print("parse cache: skip writing {} entries to {}: {}".format(len(rows), self.cache_file, e))
+
+    def close(self):
+        self.flush()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
 def skip_semicolon(toks, start_idx):
     idx = start_idx
     while idx < len(toks) and toks[idx] == ";":
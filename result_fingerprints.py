@@ -0,0 +1,54 @@
+import json
+import argparse
+from evaluation_io import iter_jsonl
+
+
+def fingerprint_key(exec_result):
+    """
+    执行结果指纹的key，key相同即结果集相同（不考虑顺序）
+    执行出错、没有指纹（旧的merged_info.jsonl）或指纹不完整（流式比较提前结束）时返回None
+    """
+    fingerprint = exec_result.get("fingerprint") if exec_result else None
+    if not fingerprint or not fingerprint["complete"]:
+        return None
+    return "{normalizer}:{rows}x{columns}:{sum}:{xor}".format(**fingerprint)
+
+
+def group_by_fingerprint(runs):
+    """
+    按结果指纹对多次运行（如不同模型）的predict结果分组，只读取指纹，不需要重新执行sql或比较结果字符串
+    :param runs: list of (运行名, merged_info.jsonl)
+    :return: dict，样例id -> {"gold": gold结果的指纹key, "groups": {predict结果的指纹key: [运行名, ...]}}
+    """
+    questions = {}
+    for name, merged_info_file in runs:
+        for record in iter_jsonl(merged_info_file):
+            question = questions.setdefault(record["id"], {"gold": None, "groups": {}})
+            if question["gold"] is None:
+                question["gold"] = fingerprint_key(record["gold_exec_result"])
+            key = fingerprint_key(record["predict_exec_result"])
+            question["groups"].setdefault(key, []).append(name)
+    return questions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--merged', dest='merged', type=str, nargs='+',
+                        help='merged_info.jsonl files to compare, optionally named as name=path')
+    parser.add_argument('--id', dest='id', type=int, default=None, help='only show the runs grouped for this example')
+    parser.add_argument('--out', dest='out', type=str, default=None, help='json file to write the groups of all examples')
+    args = parser.parse_args()
+
+    runs = [tuple(merged.split('=', 1)) if '=' in merged else (merged, merged) for merged in args.merged]
+    questions = group_by_fingerprint(runs)
+    if args.out is not None:
+        with open(args.out, "w", encoding="utf-8") as w:
+            json.dump(questions, w, indent=4)
+    if args.id is not None:
+        question = questions[args.id]
+        print("gold: {}".format(question["gold"]))
+        for key, names in question["groups"].items():
+            print("{} {}: {}".format("*" if key is not None and key == question["gold"] else " ", key, ", ".join(names)))
+    else:
+        agree = sum(1 for question in questions.values() if len(question["groups"]) == 1)
+        print("{} examples, all {} runs produced the same result set for {}".format(len(questions), len(runs), agree))
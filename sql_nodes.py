@@ -0,0 +1,157 @@
+################################
+# Compact, immutable form of the sql dicts produced by process_sql.get_sql
+#
+# Every node is a namedtuple: slotted, hashable, and equal to the plain tuple of the
+# dict format with the same fields, so units can be put in sets / Counters directly.
+# Lists become tuples, column/table ids and string values are interned.
+#
+# col_unit:   ColUnit(agg_id, col_id, is_distinct)
+# val_unit:   ValUnit(unit_op, col_unit1, col_unit2)
+# table_unit: TableUnit(table_type, table)            table: table id or SQL
+# cond_unit:  CondUnit(not_op, op_id, val_unit, val1, val2)
+#             val: number / string / ColUnit / SQL
+# condition:  (cond_unit1, 'and'/'or', cond_unit2, ...)
+# SQL(select=Select(is_distinct, ((agg_id, val_unit), ...)),
+#     table_units=(table_unit, ...), from_conds=condition, where=condition,
+#     group_by=(col_unit, ...), having=condition,
+#     order_by=None/OrderBy('asc'/'desc', (val_unit, ...)), limit=None/limit value,
+#     intersect=None/SQL, union=None/SQL, except_=None/SQL)
+#
+# sql_to_dict(sql_from_dict(sql)) == sql for every parsed (or rebuilt) sql dict.
+################################
+
+import sys
+import collections
+
+ColUnit = collections.namedtuple("ColUnit", ["agg_id", "col_id", "is_distinct"])
+ValUnit = collections.namedtuple("ValUnit", ["unit_op", "col_unit1", "col_unit2"])
+TableUnit = collections.namedtuple("TableUnit", ["table_type", "table"])
+CondUnit = collections.namedtuple("CondUnit", ["not_op", "op_id", "val_unit", "val1", "val2"])
+Select = collections.namedtuple("Select", ["is_distinct", "units"])
+OrderBy = collections.namedtuple("OrderBy", ["direction", "val_units"])
+SQL = collections.namedtuple("SQL", ["select", "table_units", "from_conds", "where", "group_by", "having",
+                                     "order_by", "limit", "intersect", "union", "except_"])
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def col_unit_from_dict(col_unit):
+    if col_unit is None:
+        return None
+    agg_id, col_id, is_distinct = col_unit
+    return ColUnit(agg_id, _intern(col_id), is_distinct)
+
+
+def val_unit_from_dict(val_unit):
+    if val_unit is None:
+        return None
+    unit_op, col_unit1, col_unit2 = val_unit
+    return ValUnit(unit_op, col_unit_from_dict(col_unit1), col_unit_from_dict(col_unit2))
+
+
+def value_from_dict(val):
+    if type(val) is dict:
+        return sql_from_dict(val)
+    if isinstance(val, tuple):
+        return col_unit_from_dict(val)
+    return _intern(val)
+
+
+def cond_unit_from_dict(cond_unit):
+    if cond_unit is None:
+        return None
+    not_op, op_id, val_unit, val1, val2 = cond_unit
+    return CondUnit(not_op, op_id, val_unit_from_dict(val_unit), value_from_dict(val1), value_from_dict(val2))
+
+
+def condition_from_dict(condition):
+    return tuple(cond_unit_from_dict(it) if idx % 2 == 0 else it for idx, it in enumerate(condition))
+
+
+def table_unit_from_dict(table_unit):
+    table_type, table = table_unit
+    if type(table) is dict:
+        return TableUnit(table_type, sql_from_dict(table))
+    return TableUnit(table_type, _intern(table))
+
+
+def sql_from_dict(sql):
+    if sql is None:
+        return None
+    is_distinct, units = sql['select']
+    order_by = None
+    if len(sql['orderBy']) > 0:
+        direction, val_units = sql['orderBy']
+        order_by = OrderBy(direction, tuple(val_unit_from_dict(val_unit) for val_unit in val_units))
+    return SQL(
+        select=Select(is_distinct, tuple((agg_id, val_unit_from_dict(val_unit)) for agg_id, val_unit in units)),
+        table_units=tuple(table_unit_from_dict(table_unit) for table_unit in sql['from']['table_units']),
+        from_conds=condition_from_dict(sql['from']['conds']),
+        where=condition_from_dict(sql['where']),
+        group_by=tuple(col_unit_from_dict(col_unit) for col_unit in sql['groupBy']),
+        having=condition_from_dict(sql['having']),
+        order_by=order_by,
+        limit=sql['limit'],
+        intersect=sql_from_dict(sql['intersect']),
+        union=sql_from_dict(sql['union']),
+        except_=sql_from_dict(sql['except']),
+    )
+
+
+def col_unit_to_dict(col_unit):
+    return tuple(col_unit) if col_unit is not None else None
+
+
+def val_unit_to_dict(val_unit):
+    if val_unit is None:
+        return None
+    return val_unit.unit_op, col_unit_to_dict(val_unit.col_unit1), col_unit_to_dict(val_unit.col_unit2)
+
+
+def value_to_dict(val):
+    if isinstance(val, SQL):
+        return sql_to_dict(val)
+    if isinstance(val, ColUnit):
+        return tuple(val)
+    return val
+
+
+def cond_unit_to_dict(cond_unit):
+    if cond_unit is None:
+        return None
+    return (cond_unit.not_op, cond_unit.op_id, val_unit_to_dict(cond_unit.val_unit),
+            value_to_dict(cond_unit.val1), value_to_dict(cond_unit.val2))
+
+
+def condition_to_dict(condition):
+    return [cond_unit_to_dict(it) if idx % 2 == 0 else it for idx, it in enumerate(condition)]
+
+
+def table_unit_to_dict(table_unit):
+    table = table_unit.table
+    return table_unit.table_type, sql_to_dict(table) if isinstance(table, SQL) else table
+
+
+def sql_to_dict(sql):
+    if sql is None:
+        return None
+    order_by = []
+    if sql.order_by is not None:
+        order_by = (sql.order_by.direction, [val_unit_to_dict(val_unit) for val_unit in sql.order_by.val_units])
+    return {
+        'from': {
+            'table_units': [table_unit_to_dict(table_unit) for table_unit in sql.table_units],
+            'conds': condition_to_dict(sql.from_conds)
+        },
+        'select': (sql.select.is_distinct, [(agg_id, val_unit_to_dict(val_unit)) for agg_id, val_unit in sql.select.units]),
+        'where': condition_to_dict(sql.where),
+        'groupBy': [col_unit_to_dict(col_unit) for col_unit in sql.group_by],
+        'having': condition_to_dict(sql.having),
+        'orderBy': order_by,
+        'limit': sql.limit,
+        'intersect': sql_to_dict(sql.intersect),
+        'union': sql_to_dict(sql.union),
+        'except': sql_to_dict(sql.except_),
+    }
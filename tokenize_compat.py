@@ -0,0 +1,114 @@
+import os
+import sys
+import glob
+import json
+import argparse
+from evaluation_io import iter_jsonl
+from process_sql import tokenize
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# 已知的不一致：(文件, 行号) -> 原因。都是模型输出的说明文字而不是sql，
+# process_sql.tokenize不复现nltk按punkt分句后对句末'.'的处理，两种分词结果都不能解析为sql
+KNOWN_DIFFERENCES = {
+    ("Output/gpt-3.5-turbo_2.0/predict.jsonl", 601): "prompt echoed before the sql, '. AI:' inside prose",
+    ("Output/gpt-3.5-turbo_2.0/predict.jsonl", 602): "prompt echoed before the sql, '. AI:' inside prose",
+    ("Output/gpt-3.5-turbo_2.0/predict.jsonl", 603): "prompt echoed before the sql, '. AI:' inside prose",
+    ("Output/gpt-3.5-turbo_2.0/predict.jsonl", 912): "prompt echoed before the sql, '? AI:' inside prose",
+}
+
+
+def nltk_tokenize(string):
+    """process_sql.tokenize改为单遍词法分析之前基于nltk word_tokenize的实现，作为对照"""
+    from nltk import word_tokenize
+
+    string = str(string)
+    string = string.replace("\'", "\"")
+    quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
+    assert len(quote_idxs) % 2 == 0, "Unexpected quote"
+
+    vals = {}
+    for i in range(len(quote_idxs)-1, -1, -2):
+        qidx1 = quote_idxs[i-1]
+        qidx2 = quote_idxs[i]
+        val = string[qidx1: qidx2+1]
+        key = "__val_{}_{}__".format(qidx1, qidx2)
+        string = string[:qidx1] + key + string[qidx2+1:]
+        vals[key] = val
+
+    toks = [word.lower() for word in word_tokenize(string)]
+    for i in range(len(toks)):
+        if toks[i] in vals:
+            toks[i] = vals[toks[i]]
+
+    eq_idxs = [idx for idx, tok in enumerate(toks) if tok == "="]
+    eq_idxs.reverse()
+    prefix = ('!', '>', '<')
+    for eq_idx in eq_idxs:
+        pre_tok = toks[eq_idx-1]
+        if pre_tok in prefix:
+            toks = toks[:eq_idx-1] + [pre_tok + "="] + toks[eq_idx+1:]
+    return toks
+
+
+def iter_sqls(root):
+    """
+    仓库中自带的sql：(文件, 行号, sql)
+    evaluation_examples下的gold/predict、dev.sql和dev.json中的sql，以及Output下各次实验的predict.jsonl
+    """
+    examples_dir = os.path.join(root, "evaluation_examples")
+    for name in ("gold_example.txt", "pred_example.txt"):
+        with open(os.path.join(examples_dir, name), "r", encoding="utf-8") as r:
+            for line_no, line in enumerate(r, 1):
+                if line.strip():
+                    yield "evaluation_examples/" + name, line_no, line.rstrip("\n").split("\t")[0]
+    with open(os.path.join(examples_dir, "dev.sql"), "r", encoding="utf-8") as r:
+        for line_no, line in enumerate(r, 1):
+            if line.startswith("SQL:"):
+                yield "evaluation_examples/dev.sql", line_no, line[len("SQL:"):].strip()
+    with open(os.path.join(examples_dir, "examples", "dev.json"), "r", encoding="utf-8") as r:
+        for idx, example in enumerate(json.load(r)):
+            yield "evaluation_examples/examples/dev.json", idx + 1, example["query"]
+    for predict_file in sorted(glob.glob(os.path.join(root, "Output", "*", "predict.jsonl"))):
+        name = os.path.relpath(predict_file, root).replace(os.sep, "/")
+        for line_no, record in enumerate(iter_jsonl(predict_file), 1):
+            yield name, line_no, record["sql"]
+
+
+def safe_tokenize(tokenizer, string):
+    try:
+        return tokenizer(string)
+    except AssertionError as e:
+        return "AssertionError: {}".format(e)
+
+
+def check_tokenize(root=current_dir):
+    """
+    用两种分词方式分别处理仓库中自带的sql
+    :return: (比较的sql数, [(文件, 行号, sql, nltk的结果, tokenize的结果), ...]，KNOWN_DIFFERENCES以外的不一致)
+    """
+    total = 0
+    differences = []
+    for name, line_no, sql in iter_sqls(root):
+        total += 1
+        expected = safe_tokenize(nltk_tokenize, sql)
+        actual = safe_tokenize(tokenize, sql)
+        if expected != actual and (name, line_no) not in KNOWN_DIFFERENCES:
+            differences.append((name, line_no, sql, expected, actual))
+    return total, differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="check that process_sql.tokenize matches the previous nltk based tokenizer on the bundled sql")
+    parser.add_argument('--root', dest='root', type=str, default=current_dir)
+    args = parser.parse_args()
+
+    total, differences = check_tokenize(args.root)
+    for name, line_no, sql, expected, actual in differences:
+        print("{}:{}: {}".format(name, line_no, sql))
+        print("    nltk:     {}".format(expected))
+        print("    tokenize: {}".format(actual))
+    print("{} sql compared, {} known differences, {} unexpected differences".format(
+        total, len(KNOWN_DIFFERENCES), len(differences)))
+    sys.exit(1 if differences else 0)